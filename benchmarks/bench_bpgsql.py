@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""
+BPgSQL benchmarks
+
+Measures throughput of decoding result rows for various mixes of
+types, encoding parameters, ingesting rows with executemany(),
+multi-row VALUES and COPY, reading and writing Large Objects, and
+connecting.  Results are written as JSON so runs can be compared.
+
+By default runs against the fake server in tests/pgstub.py, so no
+database is needed; use --dsn to run against a real server instead.
+
+    python benchmarks/bench_bpgsql.py --output before.json
+
+"""
+import datetime
+import os
+import sys
+import time
+from optparse import OptionParser
+from StringIO import StringIO
+try:
+    from decimal import Decimal
+except:
+    Decimal = float
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'tests'))
+
+import bpgsql
+import pgstub
+
+#
+# SQL expressions generating a value of each type from a
+# generate_series() counter named 'i', for real servers
+#
+EXPRESSIONS = {
+    'bool': '(i % 2 = 0)',
+    'bytea': "('abc' || i)::bytea",
+    'date': "'2008-06-11'::date + (i % 28)",
+    'float8': 'i + 0.25::float8',
+    'int4': 'i',
+    'int8': 'i::int8 * 1000000007',
+    'numeric': '(i + 0.25)::numeric',
+    'text': "'row number ' || i",
+    'timestamptz': "'2008-06-11 10:00:00-05'::timestamptz + i * interval '1 second'",
+    }
+
+#
+# Mixes of column types to decode
+#
+DECODE_MIXES = [
+    ('int4', ['int4'] * 4),
+    ('text', ['text'] * 4),
+    ('numeric', ['numeric'] * 4),
+    ('timestamptz', ['timestamptz'] * 4),
+    ('mixed', ['int4', 'text', 'numeric', 'bool', 'date', 'timestamptz', 'float8', 'int8', 'bytea']),
+    ('wide', ['int4', 'text', 'float8'] * 40),
+    ]
+
+
+def best_time(func, repeat):
+    """
+    Call func() repeat times and return the shortest time taken
+
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+
+def decode_query(typenames, nrows):
+    exprs = ['%s AS c%d' % (EXPRESSIONS[t], n) for n, t in enumerate(typenames)]
+    return 'SELECT %s FROM generate_series(1, %d) AS i' % (', '.join(exprs), nrows)
+
+
+def bytes_received(cnx, query):
+    """
+    Run a query once with a query hook installed, and return the
+    number of bytes received in response.  Hooks make every field
+    conversion get timed, so aren't left installed while benchmarking.
+
+    """
+    received = []
+    hook = lambda stats: received.append(stats.bytes_received)
+    cnx.add_query_hook(hook)
+    try:
+        cnx.cursor().execute(query)
+    finally:
+        cnx.remove_query_hook(hook)
+    return received[0]
+
+
+def bench_decode(cnx, server, options):
+    results = {}
+    cur = cnx.cursor()
+    for name, typenames in DECODE_MIXES:
+        query = decode_query(typenames, options.rows)
+        if server is not None:
+            server.add_result(query, pgstub.synthetic_result(typenames, options.rows, null_every=11))
+        nbytes = bytes_received(cnx, query)
+        elapsed = best_time(lambda: cur.execute(query), options.repeat)
+        results[name] = {
+            'columns': len(typenames),
+            'rows': options.rows,
+            'seconds': elapsed,
+            'rows_per_second': options.rows / elapsed,
+            'mb_per_second': nbytes / elapsed / 1048576,
+            }
+    return results
+
+
+def bench_encode(cnx, server, options):
+    params = [12345, u'some unicode text \u1234', 'plain string with a \' quote',
+        Decimal('1234.5678'), 3.14159, None, datetime.datetime(2008, 6, 11, 10, 11, 12),
+        datetime.date(2008, 6, 11), bpgsql.Binary('\0\1\2binary\xff')]
+    n = options.rows
+
+    def encode():
+        to_sql = cnx._python_to_sql
+        for i in xrange(n):
+            for p in params:
+                to_sql(p)
+
+    elapsed = best_time(encode, options.repeat)
+    return {
+        'parameters': n * len(params),
+        'seconds': elapsed,
+        'parameters_per_second': n * len(params) / elapsed,
+        }
+
+
+def bench_ingest(cnx, server, options):
+    n = options.rows
+    rows = [(i, 'name %d' % i, Decimal(i) / 4) for i in range(n)]
+    cur = cnx.cursor()
+    results = {}
+
+    def setup():
+        cur.execute('CREATE TABLE bench_ingest (id int4, name text, amount numeric)')
+
+    def teardown():
+        cur.execute('DROP TABLE bench_ingest')
+
+    def executemany():
+        cur.executemany('INSERT INTO bench_ingest VALUES (%s, %s, %s)', rows)
+
+    def values(batch=500):
+        for start in range(0, n, batch):
+            chunk = rows[start:start+batch]
+            cur.execute('INSERT INTO bench_ingest VALUES ' + ', '.join(['(%s, %s, %s)'] * len(chunk)),
+                [v for row in chunk for v in row])
+
+    def copy():
+        cnx.stdin = StringIO(''.join(['%d\t%s\t%s\n' % row for row in rows]))
+        try:
+            cur.execute('COPY bench_ingest FROM STDIN')
+        finally:
+            cnx.stdin = None
+
+    for name, func in [('executemany', executemany), ('values', values), ('copy', copy)]:
+        setup()
+        try:
+            elapsed = best_time(func, options.repeat)
+        finally:
+            teardown()
+        results[name] = {
+            'rows': n,
+            'seconds': elapsed,
+            'rows_per_second': n / elapsed,
+            }
+    return results
+
+
+def bench_large_objects(cnx, server, options):
+    chunk = 65536
+    data = ''.join([chr(i % 256) for i in range(chunk)])
+    nchunks = max(options.lo_size * 1048576 / chunk, 1)
+    size = nchunks * chunk
+    cur = cnx.cursor()
+
+    cur.execute('BEGIN')
+    try:
+        oid = cnx.lo_create()
+
+        def write():
+            lobj = cnx.lo_open(oid, bpgsql.INV_WRITE)
+            for i in range(nchunks):
+                lobj.write(data)
+            lobj.close()
+
+        def read():
+            lobj = cnx.lo_open(oid, bpgsql.INV_READ)
+            while lobj.read(chunk):
+                pass
+            lobj.close()
+
+        write_time = best_time(write, options.repeat)
+        read_time = best_time(read, options.repeat)
+        cnx.lo_unlink(oid)
+    finally:
+        cnx.rollback()
+
+    return {
+        'bytes': size,
+        'write_seconds': write_time,
+        'write_mb_per_second': size / write_time / 1048576,
+        'read_seconds': read_time,
+        'read_mb_per_second': size / read_time / 1048576,
+        }
+
+
+def bench_connect(cnx, server, options, dsn=None):
+    n = 20
+
+    def connect():
+        for i in range(n):
+            bpgsql.connect(dsn).close()
+
+    elapsed = best_time(connect, options.repeat)
+    return {
+        'connections': n,
+        'seconds': elapsed,
+        'ms_per_connection': elapsed / n * 1000,
+        }
+
+
+BENCHMARKS = [
+    ('decode', bench_decode),
+    ('encode', bench_encode),
+    ('ingest', bench_ingest),
+    ('large_objects', bench_large_objects),
+    ('connect', bench_connect),
+    ]
+
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options] [benchmark ...]')
+    parser.add_option('--dsn', dest='dsn',
+                        help='DataSource Name of a real server to use (default: a fake in-process server)')
+    parser.add_option('--output', dest='output',
+                        help='File to write JSON results to (default: stdout)')
+    parser.add_option('--rows', dest='rows', type='int', default=20000,
+                        help='Number of rows for row-oriented benchmarks (default: %default)')
+    parser.add_option('--lo-size', dest='lo_size', type='int', default=16,
+                        help='Megabytes of Large Object data to write and read (default: %default)')
+    parser.add_option('--repeat', dest='repeat', type='int', default=3,
+                        help='Number of times to repeat each measurement, keeping the best (default: %default)')
+
+    options, args = parser.parse_args()
+    names = args or [name for name, func in BENCHMARKS]
+
+    server = None
+    dsn = options.dsn
+    if dsn is None:
+        server = pgstub.StubServer()
+        dsn = server.dsn
+
+    report = {
+        'bpgsql_version': bpgsql.version,
+        'python_version': sys.version.split()[0],
+        'platform': sys.platform,
+        'server': (server is None and 'postgresql') or 'stub',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': {'rows': options.rows, 'lo_size': options.lo_size, 'repeat': options.repeat},
+        'results': {},
+        }
+
+    cnx = bpgsql.connect(dsn)
+    try:
+        for name, func in BENCHMARKS:
+            if name not in names:
+                continue
+            sys.stderr.write('%s...\n' % name)
+            if func is bench_connect:
+                report['results'][name] = func(cnx, server, options, dsn)
+            else:
+                report['results'][name] = func(cnx, server, options)
+    finally:
+        cnx.close()
+        if server is not None:
+            server.close()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output + '\n')
+        f.close()
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
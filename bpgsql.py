@@ -21,17 +21,52 @@ Barebones pure-python PostGreSQL
 import datetime
 import errno
 import exceptions
+import math
+import os
+import random
 import re
 import select
 import socket
 import sys
+import tempfile
+import threading
+import time
 import types
+import uuid
+import weakref
+from array import array
+from collections import deque
+from cStringIO import StringIO
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 try:
     from decimal import Decimal
 except:
     Decimal = float
+try:
+    from decimal import _dec_from_triple
+except ImportError:
+    _dec_from_triple = None
+from hashlib import md5 as _md5
+try:
+    import ipaddress
+except ImportError:
+    ipaddress = None
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+from struct import calcsize as _calcsize
 from struct import pack as _pack
+from struct import pack_into as _pack_into
 from struct import unpack as _unpack
+from struct import unpack_from as _unpack_from
+from zlib import crc32 as _crc32
 
 #
 # See Python sys.version and sys.version_info
@@ -182,6 +217,14 @@ class PostgreSQL_Timeout(InterfaceError):
     """
     pass
 
+class PostgreSQL_QueryTimeout(OperationalError):
+    """
+    Exception raised by Cursor.execute() when a command was cancelled
+    because its timeout expired.  The connection remains usable.
+
+    """
+    pass
+
 
 #
 # Constants relating to Large Object support
@@ -248,6 +291,7 @@ class _SimpleTzInfo(datetime.tzinfo):
     """
     def __init__(self, tz):
         super(_SimpleTzInfo, self).__init__()
+        self.__tz = tz
         if ':' in tz:
             hour, minute = tz.split(':')
         else:
@@ -258,6 +302,10 @@ class _SimpleTzInfo(datetime.tzinfo):
             minute = -minute
         self.offset = datetime.timedelta(hours=hour, minutes=minute)
 
+    def __getinitargs__(self):
+        # Lets pickle recreate the object
+        return (self.__tz,)
+
     def dst(self, dt):
         return None
 
@@ -302,6 +350,227 @@ def _timestamp_to_python(s):
         t.microsecond, t.tzinfo)
 
 
+_ARRAY_ELEMENT = re.compile(r'"((?:[^"\\]|\\.)*)"|([^,{}]+)')
+_ARRAY_UNESCAPE = re.compile(r'\\(.)')
+
+#
+# array.array typecode able to hold int8 values, if there is one
+#
+if array('l').itemsize >= 8:
+    _INT8_TYPECODE = 'l'
+else:
+    _INT8_TYPECODE = None
+
+def _array_converter(converter, typecode=None):
+    """
+    Make a function to convert PgSQL array strings, such as '{1,2,NULL}',
+    to Python lists, with the elements converted by the specified
+    converter.  Multi-dimensional arrays become lists of lists.  If
+    typecode is specified, innermost lists that don't contain NULLs
+    are returned as array.array objects of that type instead.
+
+    """
+    def finish(items):
+        if typecode and (None not in items):
+            if not (items and isinstance(items[0], (list, array))):
+                return array(typecode, items)
+        return items
+
+    def array_to_python(s):
+        if s[0] == '[':
+            # skip the dimensions decoration, as in '[0:1]={1,2}'
+            s = s[s.index('=')+1:]
+
+        inner = s[1:-1]
+        if ('{' not in inner) and ('"' not in inner):
+            #
+            # One-dimensional array without quoted elements, the
+            # usual case for numbers
+            #
+            if not inner:
+                return finish([])
+            items = inner.split(',')
+            if 'NULL' not in items:
+                return finish(map(converter, items))
+            values = []
+            for x in items:
+                if x == 'NULL':
+                    values.append(None)
+                else:
+                    values.append(converter(x))
+            return values
+
+        stack = []
+        pos = 0
+        while True:
+            ch = s[pos]
+            if ch == '{':
+                stack.append([])
+                pos += 1
+            elif ch == '}':
+                items = finish(stack.pop())
+                if not stack:
+                    return items
+                stack[-1].append(items)
+                pos += 1
+            elif ch == ',':
+                pos += 1
+            else:
+                m = _ARRAY_ELEMENT.match(s, pos)
+                if m.group(1) is not None:
+                    stack[-1].append(converter(_ARRAY_UNESCAPE.sub(r'\1', m.group(1))))
+                elif m.group(2) == 'NULL':
+                    stack[-1].append(None)
+                else:
+                    stack[-1].append(converter(m.group(2)))
+                pos = m.end()
+
+    return array_to_python
+
+
+_PLAIN_NUMERIC = re.compile(r'-?\d+(?:\.\d+)?$')
+
+def _numeric_to_python(s):
+    """
+    Convert PgSQL numeric string to Python Decimal, building it directly
+    from the digits when possible since that's much quicker than having
+    Decimal parse the string.  Anything else, such as NaN or Infinity,
+    is left to Decimal.
+
+    """
+    if (_dec_from_triple is None) or (_PLAIN_NUMERIC.match(s) is None):
+        return Decimal(s)
+    sign = 0
+    if s[0] == '-':
+        sign = 1
+        s = s[1:]
+    if '.' in s:
+        whole, fraction = s.split('.')
+        return _dec_from_triple(sign, (whole + fraction).lstrip('0') or '0', -len(fraction))
+    return _dec_from_triple(sign, s.lstrip('0') or '0', 0)
+
+
+def _numeric_to_int(s):
+    """
+    Convert PgSQL numeric string for a column with a scale of 0 to
+    a Python int, or a Decimal for NaN or Infinity.
+
+    """
+    try:
+        return int(s)
+    except ValueError:
+        return _numeric_to_python(s)
+
+
+def _cidr_to_python(s):
+    """
+    Convert PgSQL cidr string to a Python ipaddress network object
+
+    """
+    return ipaddress.ip_network(s.decode('ascii'))
+
+
+def _inet_to_python(s):
+    """
+    Convert PgSQL inet string to a Python ipaddress address object, or
+    an interface object if it includes a netmask.
+
+    """
+    s = s.decode('ascii')
+    if '/' in s:
+        return ipaddress.ip_interface(s)
+    return ipaddress.ip_address(s)
+
+
+_INTERVAL = re.compile(r'(?:([+-]?\d+) years? ?)?(?:([+-]?\d+) mons? ?)?(?:([+-]?\d+) days? ?)?'
+                       r'(?:([+-])?(\d+):(\d+):(\d+)(?:\.(\d+))?)?$')
+
+def _interval_to_python(s):
+    """
+    Convert PgSQL interval string to Python datetime.timedelta object,
+    counting years as 365 days and months as 30 days.  Only the default
+    'postgres' IntervalStyle is understood, intervals in other formats
+    (such as 'iso_8601' or 'sql_standard') are returned as strings.
+
+    """
+    m = _INTERVAL.match(s)
+    if m is None:
+        return _char_to_python(s)
+    years, months, days, sign, hours, minutes, seconds, fraction = m.groups()
+    days = int(years or 0) * 365 + int(months or 0) * 30 + int(days or 0)
+    result = datetime.timedelta(days)
+    if hours is not None:
+        t = datetime.timedelta(hours=int(hours), minutes=int(minutes),
+            seconds=int(seconds), microseconds=int((fraction or '').ljust(6, '0')[:6]))
+        if sign == '-':
+            t = -t
+        result += t
+    return result
+
+
+#
+# Marker for LazyJSON values that haven't been parsed yet
+#
+_UNPARSED = object()
+
+class LazyJSON(object):
+    """
+    JSON value that isn't parsed until it's used, the default
+    converter for json and jsonb columns, so values that are never
+    looked at cost no more than text.  To parse them straight
+    away instead:
+
+        cnx.register_pgsql(['json', 'jsonb'], json.loads, bpgsql.STRING)
+
+    The original text is available as the '.text' attribute, and the
+    parsed value as '.value'.  Indexing, iteration, len(), 'in', get()
+    and comparisons are passed through to the parsed value.
+
+    """
+    __slots__ = ('text', '_LazyJSON__value')
+
+    def __init__(self, text):
+        self.text = text
+        self.__value = _UNPARSED
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJSON):
+            other = other.value
+        return self.value == other
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __reduce__(self):
+        # Pickle just the text (the unparsed marker wouldn't
+        # survive), for spilled rows and shared caches
+        return (LazyJSON, (self.text,))
+
+    def __repr__(self):
+        return 'LazyJSON(%r)' % self.text
+
+    def get(self, key, default=None):
+        return self.value.get(key, default)
+
+    def __get_value(self):
+        if self.__value is _UNPARSED:
+            self.__value = json.loads(self.text)
+        return self.__value
+    value = property(__get_value)
+
+
 _ESCAPE_CHARS = re.compile("[\x00-\x1f'\\\\\x7f-\xff]")
 def _binary_to_pgsql(b):
     """
@@ -321,6 +590,25 @@ def _datetime_to_pgsql(dt):
     return "'%s'::timestamp" % dt.isoformat(' ')
 
 
+def _list_to_pgsql(obj, to_sql):
+    """
+    Convert a Python list to a PgSQL array, converting its
+    items with to_sql.
+
+    """
+    if not obj:
+        return "'{}'"
+    return 'ARRAY[%s]' % ','.join([str(to_sql(x)) for x in obj])
+
+
+def _timedelta_to_pgsql(td):
+    """
+    Convert Python datetime.timedelta to PgSQL interval.
+
+    """
+    return "'%d days %d seconds %d microseconds'::interval" % (td.days, td.seconds, td.microseconds)
+
+
 def _time_to_pgsql(t):
     """
     Convert Python datetime.time to PgSQL time.
@@ -331,6 +619,62 @@ def _time_to_pgsql(t):
     return "'%s'::time" % t.isoformat()
 
 
+def _tuple_to_pgsql(obj, to_sql):
+    """
+    Convert a Python tuple to a parenthesized list of values for
+    use with IN, converting its items with to_sql.
+
+    """
+    return '(%s)' % ', '.join([str(to_sql(x)) for x in obj])
+
+
+def _text_to_binary(s):
+    """
+    Convert a Python string to the binary format of PgSQL text types.
+
+    """
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+#
+# Conversions between Python values and the binary format of
+# fastpath function call arguments and results, by PgSQL type name
+#
+_BINARY_ENCODERS = {
+    'bool': lambda x: (x and '\x01') or '\x00',
+    'bpchar': _text_to_binary,
+    'bytea': str,
+    'char': _text_to_binary,
+    'float4': lambda x: _pack('!f', x),
+    'float8': lambda x: _pack('!d', x),
+    'int2': lambda x: _pack('!h', x),
+    'int4': lambda x: _pack('!i', x),
+    'int8': lambda x: _pack('!q', x),
+    'name': _text_to_binary,
+    'oid': lambda x: _pack('!I', x),
+    'text': _text_to_binary,
+    'varchar': _text_to_binary,
+    }
+
+_BINARY_DECODERS = {
+    'bool': lambda s: s != '\x00',
+    'bpchar': _char_to_python,
+    'bytea': Binary,
+    'char': _char_to_python,
+    'float4': lambda s: _unpack('!f', s)[0],
+    'float8': lambda s: _unpack('!d', s)[0],
+    'int2': lambda s: _unpack('!h', s)[0],
+    'int4': lambda s: _unpack('!i', s)[0],
+    'int8': lambda s: _unpack('!q', s)[0],
+    'name': _char_to_python,
+    'oid': lambda s: _unpack('!I', s)[0],
+    'text': _char_to_python,
+    'varchar': _char_to_python,
+    'void': lambda s: None,
+    }
+
+
 ################
 #
 # Helper classes and functions
@@ -394,6 +738,15 @@ class _LargeObject(object):
     open or create methods.
 
     """
+    #
+    # Default number of bytes to transfer per function call
+    # when streaming, and the number of calls to keep in flight
+    # at once (so up to chunk_size * pipeline_depth bytes may
+    # be buffered while streaming).
+    #
+    chunk_size = 65536
+    pipeline_depth = 8
+
     def __init__(self, client, fd):
         self.__client = client
         self.__fd = fd
@@ -402,6 +755,45 @@ class _LargeObject(object):
         if self.__client:
             self.close()
 
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def __read_ahead(self, nbytes, chunk_size):
+        #
+        # Generate the data read by pipelined loread calls, for up
+        # to nbytes bytes (or until the end of the object if nbytes
+        # is None).  If the caller stops early, the reads still in
+        # flight have moved the object's position past what was
+        # consumed, so it's put back.
+        #
+        def arglists(remaining):
+            while (remaining is None) or (remaining > 0):
+                if remaining is None:
+                    n = chunk_size
+                else:
+                    n = min(chunk_size, remaining)
+                    remaining -= n
+                yield (self.__fd, n)
+
+        start = self.tell()
+        consumed = 0
+        reads = self.__client._lo_pipeline('loread', arglists(nbytes), self.pipeline_depth)
+        try:
+            for data in reads:
+                if not data:
+                    break
+                try:
+                    yield data
+                except GeneratorExit:
+                    reads.close()
+                    self.seek(start + consumed + len(data), SEEK_SET)
+                    raise
+                consumed += len(data)
+                if len(data) < chunk_size:
+                    break
+        finally:
+            reads.close()
+
     def close(self):
         """
         Close an opened Large Object
@@ -411,12 +803,63 @@ class _LargeObject(object):
         finally:
             self.__client = self.__fd = None
 
+    def copy_from_file(self, f, chunk_size=None):
+        """
+        Write everything that can be read from the file object f
+        to the Large Object, return the number of bytes written.
+
+        """
+        chunk_size = chunk_size or self.chunk_size
+        def arglists():
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    return
+                yield (self.__fd, data)
+
+        total = 0
+        for r in self.__client._lo_pipeline('lowrite', arglists(), self.pipeline_depth):
+            total += _unpack('!i', r)[0]
+        return total
+
+    def copy_to_file(self, f, chunk_size=None):
+        """
+        Write the rest of the Large Object to the file object f,
+        return the number of bytes copied.
+
+        """
+        total = 0
+        for data in self.__read_ahead(None, chunk_size or self.chunk_size):
+            f.write(data)
+            total += len(data)
+        return total
+
     def flush(self):
         pass
 
+    def iter_chunks(self, chunk_size=None):
+        """
+        Iterate over the rest of the Large Object in strings of
+        chunk_size bytes (the last may be shorter).
+
+        """
+        return self.__read_ahead(None, chunk_size or self.chunk_size)
+
     def read(self, readlen):
         return self.__client._lo_funcall('loread', self.__fd, readlen)
 
+    def readinto(self, buf):
+        """
+        Read up to len(buf) bytes into buf, a writable buffer such
+        as a bytearray or mmap, return the number of bytes read.
+
+        """
+        pos = 0
+        for data in self.__read_ahead(len(buf), self.chunk_size):
+            buf[pos:pos+len(data)] = data
+            pos += len(data)
+        return pos
+
     def seek(self, offset, whence):
         self.__client._lo_funcall('lo_lseek', self.__fd, offset, whence)
 
@@ -447,6 +890,122 @@ class _PgType(object):
 _DEFAULT_PGTYPE = _PgType('unknown', _char_to_python, 'unknown')
 
 
+def _row_size(row):
+    """
+    Rough estimate of the number of bytes of memory held by a row
+    (a list of field values).
+
+    """
+    size = sys.getsizeof(row)
+    for field in row:
+        size += sys.getsizeof(field)
+    return size
+
+
+class _SpillingRows(object):
+    """
+    List-like holder for the rows of a result set.  Rows are kept
+    in memory until the estimated size exceeds memory_limit bytes,
+    after which further rows are pickled to a temporary file and
+    read back on demand.
+
+    Supports append(), len() and indexing or slicing, which is
+    all that's needed by the Cursor class.
+
+    """
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+        self.__rows = []
+        self.__file = None
+        self.__offsets = None
+        self.__end = 0
+
+
+    def __len__(self):
+        if self.__offsets is None:
+            return len(self.__rows)
+        return len(self.__rows) + len(self.__offsets)
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self.__get_range(start, stop)
+
+        if index < 0:
+            index += len(self)
+        if (index < 0) or (index >= len(self)):
+            raise IndexError('row index out of range')
+        return self.__get_range(index, index+1)[0]
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+    def __get_range(self, start, stop):
+        #
+        # Return a list of rows start..stop-1 (both already clipped
+        # to the valid range), reading spilled rows back from the
+        # temp file in one go.
+        #
+        nmem = len(self.__rows)
+        result = self.__rows[start:stop]
+        if (stop <= nmem) or (start >= stop):
+            return result
+
+        first = max(start, nmem) - nmem
+        last = stop - nmem
+        offsets = self.__offsets
+        if last < len(offsets):
+            end = offsets[last]
+        else:
+            end = self.__end
+        self.__file.seek(offsets[first])
+        data = self.__file.read(end - offsets[first])
+
+        base = offsets[first]
+        for i in range(first, last):
+            if i + 1 < last:
+                row_end = offsets[i+1] - base
+            else:
+                row_end = len(data)
+            result.append(pickle.loads(data[offsets[i] - base:row_end]))
+        return result
+
+
+    def in_memory(self):
+        """
+        Return the rows as a plain list if none were spilled
+        to disk, otherwise None.
+
+        """
+        if self.__file is None:
+            return self.__rows
+        return None
+
+
+    def append(self, row):
+        if self.__file is None:
+            self.memory_used += _row_size(row)
+            if self.memory_used <= self.memory_limit:
+                self.__rows.append(row)
+                return
+            # Over budget, everything from here on goes to disk
+            self.__file = tempfile.TemporaryFile()
+            self.__offsets = array('l')
+
+        data = pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+        self.__offsets.append(self.__end)
+        self.__file.seek(self.__end)
+        self.__file.write(data)
+        self.__end += len(data)
+
+
 class _ResultSet(object):
     """
     Helper class only used internally by the Connection class for
@@ -463,115 +1022,1500 @@ class _ResultSet(object):
         self.rows = None
         self.messages = []
 
-    def set_description(self, description):
+        #
+        # ResultSets of any statements after this one in the
+        # same query string
+        #
+        self.following = []
+
+    def set_description(self, description, memory_limit=None):
         self.description = description
         self.num_fields = len(description)
         self.null_byte_count = (self.num_fields + 7) >> 3
-        self.rows = []
-
-
-class Connection(object):
-    """
-    connection objects are created by calling this module's connect function.
+        if memory_limit is None:
+            self.rows = []
+        else:
+            self.rows = _SpillingRows(memory_limit)
 
-    """
-    def __init__(self, dsn=None, username='', password='',
-        host=None, dbname='', port='', opt=''):
-        self.__backend_pid = None
-        self.__backend_key = None
-        self.__socket = None
-        self.__input_buffer = ''
-        self.__authenticated = 0
-        self.__ready = 0
-        self.__result = None
-        self.__current_result = None
-        self.__notify_queue = []
-        self.__func_result = None
-        self.__lo_funcs = {}
-        self.__lo_funcnames = {}
-        self._pg_types = {}
-        self._oid_map = {}
-        self._python_converters = []
+    def copy(self):
+        """
+        Return a new ResultSet sharing this one's rows, but
+        with a list of its own to hold them.
 
-        #
-        # Come up with a reasonable default host for
-        # win32 and presumably Unix platforms
-        #
-        if host == None:
-            if sys.platform == 'win32':
-                host = '127.0.0.1'
-            else:
-                host = '/tmp/.s.PGSQL.5432'
+        """
+        result = _ResultSet()
+        result.completed = self.completed
+        result.conversion = self.conversion
+        result.description = self.description
+        result.error = self.error
+        result.null_byte_count = self.null_byte_count
+        result.num_fields = self.num_fields
+        if self.rows is not None:
+            result.rows = list(self.rows)
+        result.messages = list(self.messages)
+        result.query = getattr(self, 'query', None)
+        return result
 
-        args = _parseDSN(dsn)
 
-        if not args.has_key('host'):
-            args['host'] = host
-        if not args.has_key('port'):
-            args['port'] = port or 5432
-        if not args.has_key('dbname'):
-            args['dbname'] = dbname
-        if not args.has_key('user'):
-            args['user'] = username
-        if not args.has_key('password'):
-            args['password'] = password
-        if not args.has_key('options'):
-            args['options'] = opt
+#
+# Command tags that start and end an explicit transaction
+#
+_TRANSACTION_START_TAGS = ('BEGIN', 'START TRANSACTION')
+_TRANSACTION_END_TAGS = ('COMMIT', 'ROLLBACK', 'PREPARE TRANSACTION')
 
-        if args['host'].startswith('/'):
-            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            s.connect(args['host'])
-        else:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((args['host'], int(args['port'])))
+_CACHEABLE_QUERY = re.compile(r'\s*SELECT\b', re.IGNORECASE)
 
-        if not args['user']:
-            #
-            # If no userid specified in the args, try to use the userid
-            # this process is running under, if we can figure that out.
-            #
-            try:
-                import os, pwd
-                args['user'] = pwd.getpwuid(os.getuid())[0]
-            except:
-                pass
+#
+# SELECTs that lock rows, create tables, or call common builtin
+# functions whose results change from one call to the next
+#
+_UNCACHEABLE_QUERY = re.compile(r"""
+    \bFOR\s+(?:NO\s+KEY\s+)?UPDATE\b
+    | \bFOR\s+(?:KEY\s+)?SHARE\b
+    | \bINTO\b
+    | \b(?:nextval|setval|currval|lastval|random|now|clock_timestamp|statement_timestamp
+        |transaction_timestamp|timeofday|pg_sleep|txid_current|gen_random_uuid|uuid_generate_\w+)\s*\(
+    | \b(?:current_date|current_time|current_timestamp|localtime|localtimestamp)\b
+    """, re.IGNORECASE | re.VERBOSE)
 
-        self.__socket = s
-        self.__passwd = args['password']
-        self.__userid = args['user']
+#
+# Table names in FROM lists and JOIN clauses.  A FROM list ends at a
+# keyword, closing parenthesis or semicolon, and may include (up to
+# two levels of) parenthesized subqueries, which are matched on their
+# own too since the pattern is a lookahead.
+#
+_PARENTHESIZED = re.compile(r'\((?:[^()]|\([^()]*\))*\)')
+_FROM_LIST = re.compile(r"""
+    (?=\bFROM\s+
+    ((?:(?!\b(?:WHERE|GROUP|HAVING|ORDER|LIMIT|OFFSET|UNION|INTERSECT|EXCEPT|WINDOW|FOR|JOIN|INNER|LEFT
+        |RIGHT|FULL|CROSS|NATURAL|ON|USING)\b)[^;()] | \((?:[^()]|\([^()]*\))*\))*))
+    """, re.IGNORECASE | re.VERBOSE)
+_IDENTIFIER = r'(?:(?!ONLY\b)[A-Za-z_][\w$]*|"(?:[^"]|"")+")'
+_QUALIFIED_NAME = r'((?:%s\.)?%s)' % (_IDENTIFIER, _IDENTIFIER)
+_JOIN_TABLE = re.compile(r'\bJOIN\s+(?:ONLY\s+)?' + _QUALIFIED_NAME, re.IGNORECASE)
+_TABLE_NAME = re.compile(r'\s*(?:ONLY\s+)?' + _QUALIFIED_NAME, re.IGNORECASE)
+_NAME_PART = re.compile(_IDENTIFIER, re.IGNORECASE)
+_FROM = re.compile(r'\bFROM\b', re.IGNORECASE)
+
+class ResultCache(object):
+    """
+    In-process cache of query results, keyed by the exact query text
+    sent to the server.  Holds at most max_entries results, evicting
+    the least recently used, and optionally expires entries ttl seconds
+    after they were stored.
+
+    Each entry is tagged with the names of the tables the query reads
+    from, and a NOTIFY on a channel with one of those names (received
+    by a Connection using the cache) discards the entry.  So if triggers
+    on a table execute 'NOTIFY tablename' when it changes, and the
+    connection has done 'LISTEN tablename', stale results are dropped.
+    A result is not stored if one of its tables was invalidated while
+    the query was running.
+
+    May be shared by several connections, even across threads, and to
+    different databases - entries are also keyed by the server and
+    database a result came from.
 
+    """
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__tags = {}
         #
-        # Send startup packet specifying protocol version 2.0
-        #  (works with PostgreSQL 6.3 or higher?)
+        # Count of invalidations of each tag, and of clear() calls
         #
-        self.__send(_pack('!ihh64s32s64s64s64s', 296, 2, 0, args['dbname'],
-                            args['user'], args['options'], '', ''))
-        while not self.__ready:
-            self.__read_response()
-
+        self.__generations = {}
+        self.__cleared = 0
         #
-        # Get type info from the backend to help put together some dictionaries
-        # to help in converting Pgsql types to Python types.
+        # Entries are linked into a circular list in order of use,
+        # each one being [prev, next, key, result, expires, tags],
+        # where key is a (server, query) tuple
         #
-        self._initialize_types()
-        self.__initialize_type_map()
+        self.__root = root = []
+        root[:] = [root, root, None, None, None, ()]
 
 
-    def __del__(self):
-        if self.__socket:
-            self.__send('X')
-            self.__socket.close()
-            self.__socket = None
+    def __len__(self):
+        return len(self.__entries)
 
 
-    def _get_conversion(self, oid):
+    def __unlink(self, entry):
+        #
+        # Remove an entry from everything, the lock should already be held
+        #
+        prev, next = entry[0], entry[1]
+        prev[1] = next
+        next[0] = prev
+        del self.__entries[entry[2]]
+        for tag in entry[5]:
+            queries = self.__tags.get(tag)
+            if queries is not None:
+                queries.discard(entry[2])
+                if not queries:
+                    del self.__tags[tag]
+
+
+    def clear(self):
         """
-        Given an oid of a PgSQL type, come up with a Python callable
-        that will turn a string holding a representation of the value
-        into a Python object
+        Discard all cached results.
 
         """
-        return self._oid_map.get(oid, _DEFAULT_PGTYPE).converter
+        self.__lock.acquire()
+        try:
+            root = self.__root
+            root[:] = [root, root, None, None, None, ()]
+            self.__entries.clear()
+            self.__tags.clear()
+            self.__cleared += 1
+        finally:
+            self.__lock.release()
+
+
+    def generations(self, query):
+        """
+        Return a token describing how many times the tables a query
+        reads from have been invalidated, taken before the query is
+        sent and passed to store() afterwards, so a result that was
+        invalidated while the query ran isn't stored.
+
+        """
+        tags = self.tags(query)
+        self.__lock.acquire()
+        try:
+            return (self.__cleared, [self.__generations.get(tag, 0) for tag in tags])
+        finally:
+            self.__lock.release()
+
+
+    def invalidate(self, tag):
+        """
+        Discard all cached results tagged with the given table name.
+
+        """
+        tag = tag.lower()
+        self.__lock.acquire()
+        try:
+            self.__generations[tag] = self.__generations.get(tag, 0) + 1
+            for key in list(self.__tags.get(tag, ())):
+                self.__unlink(self.__entries[key])
+        finally:
+            self.__lock.release()
+
+
+    def is_cacheable(self, query):
+        """
+        Decide whether the results of a query may be cached, by default
+        only SELECT statements are, and not ones that lock rows (FOR
+        UPDATE or SHARE), create tables (SELECT INTO) or call well-known
+        volatile builtin functions such as nextval(), random() or now().
+        Nor are ones with a FROM clause that tags() finds no table
+        names in, since nothing could invalidate them.  Queries calling
+        volatile functions of your own need to be filtered out by
+        overriding this in a subclass.
+
+        """
+        if (_CACHEABLE_QUERY.match(query) is None) or (_UNCACHEABLE_QUERY.search(query) is not None):
+            return False
+        return bool(self.tags(query)) or (_FROM.search(query) is None)
+
+
+    def lookup(self, query, server=None):
+        """
+        Return a copy of the cached ResultSet for a query sent to
+        the given server, or None if there isn't one (or it has
+        expired).  'server' is anything identifying the server and
+        database, such as a (host, port, dbname) tuple.
+
+        """
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get((server, query))
+            if entry is not None and entry[4] is not None and entry[4] <= time.time():
+                self.__unlink(entry)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Move to the most-recently-used end of the list
+            prev, next = entry[0], entry[1]
+            prev[1] = next
+            next[0] = prev
+            root = self.__root
+            last = root[0]
+            last[1] = root[0] = entry
+            entry[0] = last
+            entry[1] = root
+
+            self.hits += 1
+            result = entry[3]
+        finally:
+            self.__lock.release()
+
+        return result.copy()
+
+
+    def store(self, query, result, server=None, generations=None):
+        """
+        Save a copy of a ResultSet for a query sent to the given
+        server, if the query is cacheable.  If generations is not None,
+        it's what generations() returned before the query was sent,
+        and the result isn't saved if anything it depends on has been
+        invalidated since.
+
+        """
+        if result.error or not isinstance(result.rows, list):
+            return
+        if not self.is_cacheable(query):
+            return
+
+        tags = self.tags(query)
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.time() + self.ttl
+        result = result.copy()
+        key = (server, query)
+
+        self.__lock.acquire()
+        try:
+            if (generations is not None) and \
+                (generations != (self.__cleared, [self.__generations.get(tag, 0) for tag in tags])):
+                return
+            if key in self.__entries:
+                self.__unlink(self.__entries[key])
+            while self.__entries and len(self.__entries) >= self.max_entries:
+                self.__unlink(self.__root[1])
+
+            root = self.__root
+            last = root[0]
+            entry = [last, root, key, result, expires, tags]
+            last[1] = root[0] = entry
+            self.__entries[key] = entry
+            for tag in tags:
+                self.__tags.setdefault(tag, set()).add(key)
+        finally:
+            self.__lock.release()
+
+
+    def tags(self, query):
+        """
+        Come up with a list of tags for a query, by default the lowercased
+        names of the tables in its FROM lists and JOIN clauses (without
+        any schema or quotes).  Subclasses may want to override this.
+
+        """
+        names = _JOIN_TABLE.findall(query)
+        for from_list in _FROM_LIST.findall(query):
+            for item in _PARENTHESIZED.sub('()', from_list).split(','):
+                m = _TABLE_NAME.match(item)
+                if m:
+                    names.append(m.group(1))
+        tags = set()
+        for name in names:
+            name = _NAME_PART.findall(name)[-1]
+            if name.startswith('"'):
+                name = name[1:-1].replace('""', '"')
+            tags.add(name.lower())
+        return tuple(tags)
+
+
+
+#
+# Layout of the file behind a SharedResultCache: a header (ending with
+# a count of clear() calls), then a generation counter for each tag
+# slot, then the entry slots.
+#
+_SHARED_CACHE_MAGIC = 'BPGC'
+_SHARED_CACHE_HEADER = '!4siiiI'
+_SHARED_CACHE_CLEARED = _calcsize('!4siii')
+_SHARED_CACHE_SLOT_HEADER = '!16sdIIH'
+_SHARED_CACHE_TAG = '!II'
+
+#
+# Map the DB-API type objects used in result descriptions to names,
+# so they survive being pickled and unpickled in another process.
+#
+_TYPE_OBJECTS = {'STRING': STRING, 'BINARY': BINARY, 'NUMBER': NUMBER,
+    'DATETIME': DATETIME, 'ROWID': ROWID}
+_TYPE_OBJECT_NAMES = dict([(id(v), k) for k, v in _TYPE_OBJECTS.items()])
+
+
+def _type_object_name(obj):
+    return _TYPE_OBJECT_NAMES.get(id(obj))
+
+
+def _pack_result(result):
+    """
+    Serialize a ResultSet into a string holding the pickled command
+    tag and description, followed by a table of offsets and each
+    row pickled on its own, so rows can be unpickled individually.
+
+    """
+    f = StringIO()
+    p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    p.persistent_id = _type_object_name
+    p.dump((result.completed, result.description))
+    header = f.getvalue()
+
+    rows = [pickle.dumps(row, pickle.HIGHEST_PROTOCOL) for row in result.rows]
+    offsets = [0]
+    for row in rows:
+        offsets.append(offsets[-1] + len(row))
+
+    return ''.join([_pack('!II', len(header), len(rows)), header,
+        _pack('!%dI' % len(offsets), *offsets)] + rows)
+
+
+class _PackedRows(object):
+    """
+    Read-only list-like view of the rows in a string built
+    by _pack_result(), unpickling rows only as they're accessed.
+
+    """
+    def __init__(self, data, nrows, offset):
+        self.__data = data
+        self.__nrows = nrows
+        self.__offsets = offset
+        self.__rows = offset + 4 * (nrows + 1)
+
+
+    def __len__(self):
+        return self.__nrows
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.__nrows))]
+
+        if index < 0:
+            index += self.__nrows
+        if (index < 0) or (index >= self.__nrows):
+            raise IndexError('row index out of range')
+        start, end = _unpack_from('!II', self.__data, self.__offsets + 4 * index)
+        return pickle.loads(self.__data[self.__rows + start:self.__rows + end])
+
+
+    def __iter__(self):
+        for i in range(self.__nrows):
+            yield self[i]
+
+
+def _unpack_result(data):
+    """
+    Turn a string built by _pack_result() back into a ResultSet,
+    whose rows are unpickled on demand.
+
+    """
+    header_len, nrows = _unpack_from('!II', data)
+    u = pickle.Unpickler(StringIO(data[8:8 + header_len]))
+    u.persistent_load = _TYPE_OBJECTS.__getitem__
+    completed, description = u.load()
+
+    result = _ResultSet()
+    result.completed = completed
+    result.description = description
+    result.num_fields = len(description)
+    result.rows = _PackedRows(data, nrows, 8 + header_len)
+    return result
+
+
+class SharedResultCache(ResultCache):
+    """
+    Query result cache stored in a memory-mapped file, so that several
+    processes (such as pre-forked server workers) opening the same path
+    share cached results.  The first process to open the path creates
+    the file, with room for 'slots' entries of up to 'slot_size' bytes
+    each, later ones use the layout already in the file.
+
+    Each query maps to a single slot (a newer result simply replaces
+    whatever was there), and results too big for a slot aren't cached.
+    Rows are stored pickled individually, and are only unpickled when a
+    cursor fetches them.
+
+    Invalidating a tag bumps a generation counter in the file, which
+    makes entries tagged with it stale for every process at once.
+    Entries record the generations (and the count of clear() calls)
+    as they were before their query was sent, so invalidations or
+    clearing while it ran make them stale too.
+
+    Call close() to release the file when done with the cache.
+
+    """
+    def __init__(self, path, slots=1024, slot_size=65536, ttl=None, tag_slots=4096):
+        import fcntl
+        import mmap
+
+        ResultCache.__init__(self, slots, ttl)
+        self.__flock = fcntl.flock
+        self.__LOCK_SH = fcntl.LOCK_SH
+        self.__LOCK_EX = fcntl.LOCK_EX
+        self.__LOCK_UN = fcntl.LOCK_UN
+        self.__lock = threading.Lock()
+
+        header_size = _calcsize(_SHARED_CACHE_HEADER)
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+        fcntl.flock(self.__fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.__fd).st_size < header_size:
+                size = header_size + 4 * tag_slots + slots * slot_size
+                os.ftruncate(self.__fd, size)
+                os.write(self.__fd, _pack(_SHARED_CACHE_HEADER, _SHARED_CACHE_MAGIC,
+                    slots, slot_size, tag_slots, 0))
+            os.lseek(self.__fd, 0, 0)
+            magic, slots, slot_size, tag_slots, cleared = _unpack(_SHARED_CACHE_HEADER,
+                os.read(self.__fd, header_size))
+            if magic != _SHARED_CACHE_MAGIC:
+                raise InterfaceError('%s is not a bpgsql shared cache file' % path)
+            size = os.fstat(self.__fd).st_size
+            self.__map = mmap.mmap(self.__fd, size)
+        finally:
+            fcntl.flock(self.__fd, fcntl.LOCK_UN)
+
+        self.max_entries = slots
+        self.slot_size = slot_size
+        self.__tag_slots = tag_slots
+        self.__tag_base = header_size
+        self.__slot_base = header_size + 4 * tag_slots
+
+
+    def __acquire(self, mode):
+        self.__lock.acquire()
+        try:
+            if self.__fd is None:
+                raise InterfaceError('SharedResultCache has been closed')
+            self.__flock(self.__fd, mode)
+        except:
+            self.__lock.release()
+            raise
+
+
+    def __release(self):
+        try:
+            self.__flock(self.__fd, self.__LOCK_UN)
+        finally:
+            self.__lock.release()
+
+
+    def __len__(self):
+        n = 0
+        empty = '\0' * 16
+        self.__acquire(self.__LOCK_SH)
+        try:
+            for i in range(self.max_entries):
+                offset = self.__slot_base + i * self.slot_size
+                if self.__map[offset:offset+16] != empty:
+                    n += 1
+        finally:
+            self.__release()
+        return n
+
+
+    def __digest(self, query, server):
+        #
+        # Hash identifying a query sent to a server
+        #
+        return _md5(repr(server) + '\0' + query).digest()
+
+
+    def __slot(self, digest):
+        #
+        # Offset in the file of the slot for a query digest
+        #
+        return self.__slot_base + (_unpack('!I', digest[:4])[0] % self.max_entries) * self.slot_size
+
+
+    def __tag_offset(self, tag):
+        #
+        # Offset in the file of the generation counter for a tag
+        #
+        return self.__tag_base + 4 * ((_crc32(tag) & 0xffffffff) % self.__tag_slots)
+
+
+    def clear(self):
+        """
+        Discard all cached results.
+
+        """
+        empty = '\0' * 16
+        self.__acquire(self.__LOCK_EX)
+        try:
+            for i in range(self.max_entries):
+                offset = self.__slot_base + i * self.slot_size
+                self.__map[offset:offset+16] = empty
+            cleared = _unpack_from('!I', self.__map, _SHARED_CACHE_CLEARED)[0]
+            _pack_into('!I', self.__map, _SHARED_CACHE_CLEARED, (cleared + 1) & 0xffffffff)
+        finally:
+            self.__release()
+
+
+    def close(self):
+        """
+        Release the memory map and file descriptor, the cache
+        can't be used after this.
+
+        """
+        self.__lock.acquire()
+        try:
+            if self.__map is not None:
+                self.__map.close()
+                os.close(self.__fd)
+                self.__map = self.__fd = None
+        finally:
+            self.__lock.release()
+
+
+    def generations(self, query):
+        """
+        Return the generation counters of the tags for a query (and
+        the count of clear() calls), taken before the query is sent
+        and passed to store() afterwards, so that the stored entry is
+        stale if any of them were invalidated while the query ran.
+
+        """
+        tag_offsets = [self.__tag_offset(tag) for tag in self.tags(query)]
+        self.__acquire(self.__LOCK_SH)
+        try:
+            return (_unpack_from('!I', self.__map, _SHARED_CACHE_CLEARED)[0],
+                [(t, _unpack_from('!I', self.__map, t)[0]) for t in tag_offsets])
+        finally:
+            self.__release()
+
+
+    def invalidate(self, tag):
+        """
+        Make all results tagged with the given table name stale, in
+        every process using the cache file.
+
+        """
+        offset = self.__tag_offset(tag.lower())
+        self.__acquire(self.__LOCK_EX)
+        try:
+            generation = _unpack_from('!I', self.__map, offset)[0]
+            _pack_into('!I', self.__map, offset, (generation + 1) & 0xffffffff)
+        finally:
+            self.__release()
+
+
+    def lookup(self, query, server=None):
+        """
+        Return a ResultSet for a query sent to the given server from
+        the shared cache, or None if there isn't one (or it's expired
+        or been invalidated).
+
+        """
+        digest = self.__digest(query, server)
+        offset = self.__slot(digest)
+        mm = self.__map
+        data = None
+
+        self.__acquire(self.__LOCK_SH)
+        try:
+            slot_digest, expires, cleared, length, ntags = _unpack_from(_SHARED_CACHE_SLOT_HEADER, mm, offset)
+            if (slot_digest == digest) and ((not expires) or (expires > time.time())) and \
+                (cleared == _unpack_from('!I', mm, _SHARED_CACHE_CLEARED)[0]):
+                offset += _calcsize(_SHARED_CACHE_SLOT_HEADER)
+                for i in range(ntags):
+                    tag_offset, generation = _unpack_from(_SHARED_CACHE_TAG, mm, offset)
+                    if _unpack_from('!I', mm, tag_offset)[0] != generation:
+                        break
+                    offset += 8
+                else:
+                    data = mm[offset:offset+length]
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self.__release()
+
+        if data is None:
+            return None
+
+        result = _unpack_result(data)
+        result.query = query
+        return result
+
+
+    def store(self, query, result, server=None, generations=None):
+        """
+        Save a ResultSet for a query sent to the given server in the
+        shared cache, if the query is cacheable and the result fits
+        in a slot.  If generations is not None, it's what generations()
+        returned before the query was sent, and is stored instead of
+        the current generations of the query's tags.
+
+        """
+        if result.error or not isinstance(result.rows, list):
+            return
+        if not self.is_cacheable(query):
+            return
+
+        if generations is None:
+            generations = self.generations(query)
+        cleared, generations = generations
+        data = _pack_result(result)
+        header_size = _calcsize(_SHARED_CACHE_SLOT_HEADER) + 8 * len(generations)
+        if header_size + len(data) > self.slot_size:
+            return
+
+        if self.ttl is None:
+            expires = 0
+        else:
+            expires = time.time() + self.ttl
+
+        digest = self.__digest(query, server)
+        offset = self.__slot(digest)
+        mm = self.__map
+
+        tags = [_pack(_SHARED_CACHE_TAG, t, generation) for t, generation in generations]
+        slot = ''.join([_pack(_SHARED_CACHE_SLOT_HEADER, digest, expires,
+            cleared, len(data), len(tags))] + tags + [data])
+
+        self.__acquire(self.__LOCK_EX)
+        try:
+            # Don't replace whatever's in the slot with an already stale result
+            if cleared != _unpack_from('!I', mm, _SHARED_CACHE_CLEARED)[0]:
+                return
+            mm[offset:offset+len(slot)] = slot
+        finally:
+            self.__release()
+
+
+class QueryStats(object):
+    """
+    Information about a single command, passed to hooks added with
+    Connection.add_query_hook().  Times are in floating-point seconds
+    since the command started being sent:
+
+        query               the command exactly as sent to the backend
+        template            the command before any arguments were
+                            substituted into it
+        send_time           time to send the command
+        first_byte_time     time until the first byte of the response arrived
+        ready_time          time until the backend was ready for another command
+        conversion_time     total time spent converting field values
+                            to Python objects (included in ready_time)
+        bytes_sent          bytes sent to the backend
+        bytes_received      bytes received from the backend
+        rowcount            rows returned or affected, -1 if not known
+        command             the command tag sent by the backend, such
+                            as 'SELECT' or 'INSERT 0 1'
+        error               exception describing an error, or None
+        cache_hit           True if the result came from the
+                            Connection's result_cache without the
+                            command being sent (so nothing was
+                            sent or received)
+
+    """
+    def __init__(self, query, template):
+        self.query = query
+        self.template = template
+        self.start = time.time()
+        self.send_time = None
+        self.first_byte_time = None
+        self.ready_time = None
+        self.conversion_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.rowcount = -1
+        self.command = None
+        self.error = None
+        self.cache_hit = False
+
+
+    def finish(self, result):
+        """
+        Fill in the details from a completed ResultSet.
+
+        """
+        self.ready_time = time.time() - self.start
+        self.command = result.completed
+        self.error = result.error
+        if result.rows is not None:
+            self.rowcount = len(result.rows)
+        elif result.completed:
+            try:
+                self.rowcount = int(result.completed.split(' ')[-1])
+            except ValueError:
+                pass
+
+
+    def received(self, data):
+        """
+        Account for data read from the backend.
+
+        """
+        if self.first_byte_time is None:
+            self.first_byte_time = time.time() - self.start
+        self.bytes_received += len(data)
+
+
+    def conversion_total(self):
+        """
+        Return the (dictionary, key) pair that _timed_converter()
+        should add conversion times to.
+
+        """
+        return (self.__dict__, 'conversion_time')
+
+
+def _timed_converter(converter, totals):
+    """
+    Wrap a conversion function so the time spent in it is added
+    to each of a list of totals, (dictionary, key) pairs as returned
+    by the conversion_total() methods of QueryStats and _ProfileSample.
+    So a field is only timed once however many things want to know.
+
+    """
+    clock = time.time
+    def timed_converter(s):
+        t = clock()
+        try:
+            return converter(s)
+        finally:
+            elapsed = clock() - t
+            for d, key in totals:
+                d[key] += elapsed
+    return timed_converter
+
+
+_NORMALIZE_QUERY = re.compile(r"""
+      (?P<literal>[Ee]?'(?:[^']|'')*'               # string literal
+      | %(?:\([^)]*\))?s                             # argument placeholder
+      | (?<![\w$])-?\d+(?:\.\d*)?(?:[Ee][-+]?\d+)?  # number
+      )
+    | (?P<space>\s+)
+    """, re.VERBOSE)
+
+def _normalize_query(template):
+    """
+    Reduce a command template to a fingerprint shared by all its
+    executions: argument placeholders and literal strings or numbers
+    become '?', and runs of whitespace become a single space.
+
+    """
+    def replace(m):
+        if m.group('space'):
+            return ' '
+        return '?'
+    return _NORMALIZE_QUERY.sub(replace, template).strip()
+
+
+class _StatementEntry(object):
+    """
+    Running totals for a single normalized statement, used by the
+    StatementStatistics class.
+
+    """
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = {}
+
+
+class StatementStatistics(object):
+    """
+    Query hook (see Connection.add_query_hook()) that keeps statistics
+    about the commands executed, grouped by normalized command text,
+    somewhat like PostgreSQL's pg_stat_statements.  Arguments and
+    literal values are replaced by '?' when grouping, so the same
+    statement with different values counts as one.
+
+    Times are kept in a histogram with buckets about 19% wide, which
+    the reported percentiles are estimated from.  May be shared by
+    several connections, even across threads.
+
+    """
+    #
+    # Histogram buckets are powers of this, in microseconds
+    #
+    BUCKET_BASE = 2 ** 0.25
+
+    #
+    # Number of distinct command templates to remember the normalized
+    # form of, so each only needs normalizing once
+    #
+    MAX_TEMPLATES = 10000
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__normalized = {}
+        self.__log_base = math.log(self.BUCKET_BASE)
+
+
+    def __call__(self, stats):
+        fingerprint = self.__normalized.get(stats.template)
+        if fingerprint is None:
+            if len(self.__normalized) >= self.MAX_TEMPLATES:
+                self.__normalized.clear()
+            fingerprint = self.__normalized[stats.template] = _normalize_query(stats.template)
+
+        elapsed = stats.ready_time
+        if elapsed > 0.000001:
+            bucket = int(math.log(elapsed * 1000000) / self.__log_base)
+        else:
+            bucket = 0
+
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get(fingerprint)
+            if entry is None:
+                entry = self.__entries[fingerprint] = _StatementEntry()
+            entry.calls += 1
+            if stats.cache_hit:
+                entry.cache_hits += 1
+            if stats.error is not None:
+                entry.errors += 1
+            if stats.rowcount > 0:
+                entry.rows += stats.rowcount
+            entry.total_time += elapsed
+            if elapsed > entry.max_time:
+                entry.max_time = elapsed
+            entry.histogram[bucket] = entry.histogram.get(bucket, 0) + 1
+        finally:
+            self.__lock.release()
+
+
+    def __percentiles(self, entry, fractions):
+        #
+        # Estimate times for each of a list of fractions (0.5, 0.95, ..)
+        # from the histogram, using the upper bound of the bucket the
+        # fraction falls in (but never more than the maximum seen)
+        #
+        result = []
+        buckets = sorted(entry.histogram.items())
+        for fraction in fractions:
+            target = fraction * entry.calls
+            seen = 0
+            for bucket, count in buckets:
+                seen += count
+                if seen >= target:
+                    break
+            result.append(min(self.BUCKET_BASE ** (bucket + 1) / 1000000, entry.max_time))
+        return result
+
+
+    def reset(self):
+        """
+        Discard all collected statistics.
+
+        """
+        self.__lock.acquire()
+        try:
+            self.__entries = {}
+        finally:
+            self.__lock.release()
+
+
+    def snapshot(self):
+        """
+        Return a list of dictionaries, one per normalized statement with
+        the keys: query, calls, cache_hits, errors, rows, total_time,
+        mean_time, max_time, p50, p95 and p99 (times in floating-point
+        seconds), sorted with the greatest total_time first.
+
+        """
+        self.__lock.acquire()
+        try:
+            result = []
+            for query, entry in self.__entries.items():
+                p50, p95, p99 = self.__percentiles(entry, [0.5, 0.95, 0.99])
+                result.append({
+                    'query': query,
+                    'calls': entry.calls,
+                    'cache_hits': entry.cache_hits,
+                    'errors': entry.errors,
+                    'rows': entry.rows,
+                    'total_time': entry.total_time,
+                    'mean_time': entry.total_time / entry.calls,
+                    'max_time': entry.max_time,
+                    'p50': p50,
+                    'p95': p95,
+                    'p99': p99,
+                    })
+        finally:
+            self.__lock.release()
+
+        result.sort(key=lambda x: x['total_time'], reverse=True)
+        return result
+
+
+class _ProfileSample(object):
+    """
+    Times accumulated while reading the response to a single
+    command, for merging into a ProtocolProfiler.
+
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.wait_time = 0.0
+        self.convert_time = {}
+
+
+    def conversion_total(self, name):
+        """
+        Return the (dictionary, key) pair that _timed_converter()
+        should add conversion times for the named pgsql type to.
+
+        """
+        self.convert_time.setdefault(name, 0.0)
+        return (self.convert_time, name)
+
+
+class ProtocolProfiler(object):
+    """
+    Accumulate where the time goes while a Connection reads responses
+    from the backend: waiting for data to arrive, parsing the protocol
+    messages, and converting field values to Python objects (broken
+    down by pgsql type name).
+
+    Assign one to Connection.profiler to use it, sample_rate is the
+    fraction of commands to profile.  May be shared by several
+    connections, even across threads.
+
+    """
+    def __init__(self, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self.__lock = threading.Lock()
+        self.reset()
+
+
+    def add(self, sample):
+        """
+        Merge the times from a _ProfileSample for a completed command.
+
+        """
+        elapsed = time.time() - sample.start
+        convert_time = sum(sample.convert_time.values())
+        self.__lock.acquire()
+        try:
+            self.commands += 1
+            self.wait_time += sample.wait_time
+            self.parse_time += elapsed - sample.wait_time - convert_time
+            for name, t in sample.convert_time.items():
+                self.convert_time[name] = self.convert_time.get(name, 0.0) + t
+        finally:
+            self.__lock.release()
+
+
+    def report(self):
+        """
+        Return a dictionary with the keys:
+
+            commands    number of commands profiled
+            wait        seconds spent waiting for data from the backend
+            parse       seconds spent handling protocol messages
+            convert     dictionary of pgsql type name -> seconds spent
+                        converting values of that type
+
+        """
+        self.__lock.acquire()
+        try:
+            return {
+                'commands': self.commands,
+                'wait': self.wait_time,
+                'parse': self.parse_time,
+                'convert': self.convert_time.copy(),
+                }
+        finally:
+            self.__lock.release()
+
+
+    def reset(self):
+        """
+        Discard all accumulated times.
+
+        """
+        self.__lock.acquire()
+        try:
+            self.commands = 0
+            self.wait_time = 0.0
+            self.parse_time = 0.0
+            self.convert_time = {}
+        finally:
+            self.__lock.release()
+
+
+    def sample(self):
+        """
+        Decide whether to profile a command, returning a new
+        _ProfileSample if so, or None if not.
+
+        """
+        if random.random() < self.sample_rate:
+            return _ProfileSample()
+        return None
+
+
+#
+# Row messages start with a bitmap of which fields are not null,
+# this table expands each possible byte of the bitmap into flags
+# for the 8 fields it covers (most significant bit first).
+#
+_FIELD_PRESENCE = [tuple([bool(b & (128 >> i)) for i in range(8)]) for b in range(256)]
+
+#
+# Descriptions of functions looked up by Connection.fastcall(), shared
+# by all connections in the process: (server, function name) ->
+# (function oid, result type oid, list of argument type oids)
+#
+_function_cache = {}
+
+#
+# Large Object function oids, shared by all connections in the
+# process: server -> dictionary of function name -> oid
+#
+_lo_function_cache = {}
+
+#
+# Connection.numeric_mode values
+#
+_NUMERIC_MODES = ('decimal', 'float', 'int')
+_NUMERIC_FLOAT_ARRAY = _array_converter(float, 'd')
+
+#
+# Outgoing messages are collected in a Connection's output buffer
+# until complete, or until about this many bytes are waiting.
+#
+_OUTPUT_BUFFER_SIZE = 65536
+
+#
+# Wire logs written by Connection(record=...) start with this magic
+# string, followed by frames of: direction ('S' for bytes sent to
+# the backend, 'R' for bytes received from it), time.time() timestamp,
+# and length - and then the bytes themselves.
+#
+_WIRE_MAGIC = 'BPGW\x00\x01'
+_WIRE_FRAME = '!cdI'
+_WIRE_FRAME_SIZE = _calcsize(_WIRE_FRAME)
+
+
+def _read_wire_log(f):
+    """
+    Read a wire log from a file object, returning a list of
+    (direction, timestamp, data) tuples.
+
+    """
+    if f.read(len(_WIRE_MAGIC)) != _WIRE_MAGIC:
+        raise InterfaceError('Not a bpgsql wire log')
+    frames = []
+    while True:
+        header = f.read(_WIRE_FRAME_SIZE)
+        if len(header) < _WIRE_FRAME_SIZE:
+            return frames
+        direction, timestamp, length = _unpack(_WIRE_FRAME, header)
+        frames.append((direction, timestamp, f.read(length)))
+
+
+class _RecordingSocket(object):
+    """
+    Wrap a socket, writing everything sent or received through it
+    to a wire log.
+
+    """
+    def __init__(self, sock, log):
+        self.__socket = sock
+        if isinstance(log, basestring):
+            self.__log = open(log, 'wb')
+            self.__close_log = True
+        else:
+            self.__log = log
+            self.__close_log = False
+        self.__log.write(_WIRE_MAGIC)
+
+
+    def __getattr__(self, name):
+        return getattr(self.__socket, name)
+
+
+    def __write(self, direction, data):
+        self.__log.write(_pack(_WIRE_FRAME, direction, time.time(), len(data)))
+        self.__log.write(data)
+
+
+    def close(self):
+        self.__socket.close()
+        if self.__close_log:
+            self.__log.close()
+        else:
+            self.__log.flush()
+
+
+    def recv(self, bufsize):
+        data = self.__socket.recv(bufsize)
+        if data:
+            self.__write('R', data)
+        return data
+
+
+    def send(self, data):
+        n = self.__socket.send(data)
+        self.__write('S', data[:n])
+        return n
+
+
+    def sendall(self, data):
+        self.__socket.sendall(data)
+        self.__write('S', data)
+
+
+class ReplaySocket(object):
+    """
+    Stand-in for a socket that plays back the bytes received in a
+    wire log recorded with Connection(record=...), so the same
+    workload may be run again without a server, for example:
+
+        cnx = bpgsql.connect(dsn, sock=bpgsql.ReplaySocket('workload.log'))
+
+    The client must send the same bytes as when the log was recorded
+    (so should connect with the same dsn and run the same commands),
+    if strict is true an InterfaceError is raised as soon as it
+    doesn't.  Once the recorded responses run out, the socket
+    behaves as if the backend closed the connection.
+
+    """
+    def __init__(self, path, strict=True):
+        f = open(path, 'rb')
+        try:
+            self.frames = _read_wire_log(f)
+        finally:
+            f.close()
+        self.strict = strict
+        self.__sent = ''.join([data for direction, _, data in self.frames if direction == 'S'])
+        self.__received = ''.join([data for direction, _, data in self.frames if direction == 'R'])
+
+        #
+        # A pipe with a byte always waiting in it, so that select()
+        # and friends always find this socket readable.
+        #
+        self.__pipe = os.pipe()
+        os.write(self.__pipe[1], '\0')
+        self.rewind()
+
+
+    def __del__(self):
+        if self.__pipe:
+            os.close(self.__pipe[0])
+            os.close(self.__pipe[1])
+            self.__pipe = None
+
+
+    def __check_open(self):
+        if self.__closed:
+            raise socket.error(errno.EBADF, 'Bad file descriptor')
+
+
+    def close(self):
+        """
+        Mark the socket closed, until it's rewound for
+        another Connection.
+
+        """
+        self.__closed = True
+
+
+    def fileno(self):
+        self.__check_open()
+        return self.__pipe[0]
+
+
+    def recv(self, bufsize):
+        self.__check_open()
+        pos = self.__received_pos
+        self.__received_pos = min(pos + bufsize, len(self.__received))
+        return self.__received[pos:self.__received_pos]
+
+
+    def rewind(self):
+        """
+        Start playing back from the beginning of the log again, so
+        the socket may be used for another Connection.
+
+        """
+        self.__sent_pos = 0
+        self.__received_pos = 0
+        self.__closed = False
+
+
+    def send(self, data):
+        self.__check_open()
+        pos = self.__sent_pos
+        if self.strict and (pos < len(self.__sent)) and (self.__sent[pos:pos+len(data)] != data):
+            raise InterfaceError('Replay diverged from the recording at byte %d sent' % pos)
+        self.__sent_pos = pos + len(data)
+        return len(data)
+
+
+    def sendall(self, data):
+        self.send(data)
+
+
+    def setsockopt(self, *args):
+        pass
+
+
+class Connection(object):
+    """
+    connection objects are created by calling this module's connect function.
+
+    """
+    #
+    # Approximate number of bytes of row data a single result set may
+    # hold in memory before further rows are spilled to a temp file.
+    # None means no limit.
+    #
+    result_memory_limit = None
+
+    #
+    # ResultCache object (which may be shared with other connections)
+    # to consult before sending queries to the server, None means
+    # no caching.
+    #
+    result_cache = None
+
+    #
+    # ProtocolProfiler object to accumulate timings in, None
+    # means no profiling.
+    #
+    profiler = None
+
+    #
+    # How numeric values are converted: 'decimal' to Decimal objects,
+    # 'float' to floats, or 'int' to ints for columns declared with a
+    # scale of 0 (and Decimal objects for others).  Cursors may
+    # override this with their own numeric_mode attribute.
+    #
+    numeric_mode = 'decimal'
+
+    def __init__(self, dsn=None, username='', password='',
+        host=None, dbname='', port='', opt='', record=None, sock=None):
+        self.__backend_pid = None
+        self.__backend_key = None
+        self.__address = None
+        self.__server_key = None
+        self.__deadline = None
+        self.__timeout = None
+        self.__timed_out = False
+        self.__cancel_error = None
+        self.__in_transaction = False
+        self.__stats = None
+        self.__profile = None
+        self.__numeric_mode = 'decimal'
+        self.__socket = None
+        self.__input_buffer = ''
+        self.__output_buffer = []
+        self.__output_size = 0
+        self.__authenticated = 0
+        self.__ready = 0
+        self.__result = None
+        self.__current_result = None
+        self.__notify_queue = deque()
+        self.__func_result = None
+        self.__lo_funcs = {}
+        self._pg_types = {}
+        self._oid_map = {}
+        self._python_converters = []
+        self._query_hooks = []
+
+        #
+        # Map the first byte of each kind of backend message to the
+        # _pkt_<c> function that handles it, worked out once per class.
+        # Holds plain functions rather than bound methods, which would
+        # make a reference cycle that keeps __del__ from ever running.
+        #
+        cls = self.__class__
+        self.__dispatch = cls.__dict__.get('_Connection__dispatch_table')
+        if self.__dispatch is None:
+            self.__dispatch = {}
+            for name in dir(cls):
+                if name.startswith('_pkt_') and (len(name) == 6):
+                    self.__dispatch[name[-1]] = getattr(cls, name).im_func
+            cls.__dispatch_table = self.__dispatch
+
+        #
+        # Come up with a reasonable default host for
+        # win32 and presumably Unix platforms
+        #
+        if host == None:
+            if sys.platform == 'win32':
+                host = '127.0.0.1'
+            else:
+                host = '/tmp/.s.PGSQL.5432'
+
+        args = _parseDSN(dsn)
+
+        if not args.has_key('host'):
+            args['host'] = host
+        if not args.has_key('port'):
+            args['port'] = port or 5432
+        if not args.has_key('dbname'):
+            args['dbname'] = dbname
+        if not args.has_key('user'):
+            args['user'] = username
+        if not args.has_key('password'):
+            args['password'] = password
+        if not args.has_key('options'):
+            args['options'] = opt
+        self.__server_key = (args['host'], str(args['port']), args['dbname'])
+
+        if sock is not None:
+            #
+            # Use an already-connected socket (or something that
+            # acts like one, such as a ReplaySocket)
+            #
+            s = sock
+        else:
+            if args['host'].startswith('/'):
+                self.__address = (socket.AF_UNIX, args['host'])
+            else:
+                self.__address = (socket.AF_INET, (args['host'], int(args['port'])))
+            s = socket.socket(self.__address[0], socket.SOCK_STREAM)
+            s.connect(self.__address[1])
+            if self.__address[0] == socket.AF_INET:
+                #
+                # Messages are coalesced before sending, so there's
+                # nothing to gain by having the kernel delay them
+                #
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if record is not None:
+            s = _RecordingSocket(s, record)
+
+        if not args['user']:
+            #
+            # If no userid specified in the args, try to use the userid
+            # this process is running under, if we can figure that out.
+            #
+            try:
+                import os, pwd
+                args['user'] = pwd.getpwuid(os.getuid())[0]
+            except:
+                pass
+
+        self.__socket = s
+        self.__passwd = args['password']
+        self.__userid = args['user']
+
+        #
+        # Send startup packet specifying protocol version 2.0
+        #  (works with PostgreSQL 6.3 or higher?)
+        #
+        self.__send(_pack('!ihh64s32s64s64s64s', 296, 2, 0, args['dbname'],
+                            args['user'], args['options'], '', ''))
+        while not self.__ready:
+            self.__read_response()
+
+        #
+        # Get type info from the backend to help put together some dictionaries
+        # to help in converting Pgsql types to Python types.
+        #
+        self._initialize_types()
+        self.__initialize_type_map()
+
+
+    def __del__(self):
+        if self.__socket:
+            self.__send('X')
+            self.__socket.close()
+            self.__socket = None
+
+
+    def __funcall_message(self, oid, args):
+        #
+        # Build a Function Call message
+        #
+        msg = [_pack('!2sIi', 'F\0', oid, len(args))]
+        for arg in args:
+            atype = type(arg)
+            if (atype == types.LongType) and (arg >= 0):
+                # Make sure positive longs, such as OIDs, get
+                # sent back as unsigned ints
+                msg.append(_pack('!iI', 4, arg))
+            elif (atype == types.IntType) or (atype == types.LongType):
+                msg.append(_pack('!ii', 4, arg))
+            else:
+                msg.append(_pack('!i', len(arg)))
+                msg.append(arg)
+        return ''.join(msg)
+
+
+    def __funcall_result(self):
+        #
+        # Read the response to a Function Call message sent
+        # earlier, raising an exception if it failed
+        #
+        self.__ready = 0
+        self.__result = None
+        self.__new_result()
+        while not self.__ready:
+            self.__read_response()
+        results, self.__result = self.__result, None
+        result, self.__func_result = self.__func_result, None
+        for r in results:
+            if r.error:
+                raise r.error
+        return result
+
+
+    def __binary_conversion(self, table, oid):
+        #
+        # Find the function for converting to or from the binary
+        # format of the type with the specified oid
+        #
+        name = self._oid_map.get(oid, _DEFAULT_PGTYPE).name
+        conversion = table.get(name)
+        if conversion is None:
+            raise NotSupportedError('Type %s is not supported by fastcall' % name)
+        return conversion
+
+
+    def __flush(self):
+        #
+        # Send everything in the output buffer to the backend,
+        # make sure it's all sent
+        #
+        if self.__socket is None:
+            raise InterfaceError('Connection not open')
+
+        if len(self.__output_buffer) == 1:
+            data = self.__output_buffer[0]
+        else:
+            data = ''.join(self.__output_buffer)
+        self.__output_buffer = []
+        self.__output_size = 0
+
+        if self.__stats is not None:
+            self.__stats.bytes_sent += len(data)
+
+        while data:
+            try:
+                nSent = self.__socket.send(data)
+            except socket.error, serr:
+                if serr[0] != errno.EINTR:
+                    raise
+                continue
+            data = data[nSent:]
+
+
+    def _get_conversion(self, oid):
+        """
+        Given an oid of a PgSQL type, come up with a Python callable
+        that will turn a string holding a representation of the value
+        into a Python object
+
+        """
+        return self._oid_map.get(oid, _DEFAULT_PGTYPE).converter
 
 
     def __initialize_type_map(self):
@@ -594,12 +2538,20 @@ class Connection(object):
         #
         # Make up a dictionary mapping function names beginning with "lo"
         # to function oids (there may be some non-lobject functions
-        # in there, but that should be harmless)
+        # in there, but that should be harmless).  They're builtin
+        # functions whose oids don't change, so they're only looked
+        # up once per server, and shared by every connection.
         #
-        result = self._execute("SELECT proname, oid FROM pg_proc WHERE proname like 'lo%'")
-        for proname, oid in result.rows:
-            self.__lo_funcs[proname] = oid
-            self.__lo_funcnames[oid] = proname
+        funcs = _lo_function_cache.get(self.__server_key)
+        if funcs is None:
+            result = self._execute("SELECT proname, oid FROM pg_proc WHERE proname like 'lo%'")
+            if result.error:
+                raise result.error
+            funcs = {}
+            for proname, oid in result.rows:
+                funcs[proname] = oid
+            _lo_function_cache[self.__server_key] = funcs
+        self.__lo_funcs = funcs
 
 
     def __new_result(self):
@@ -638,6 +2590,46 @@ class Connection(object):
         return obj
 
 
+    def __lookup_function(self, name):
+        #
+        # Get the oid, result type and argument types of a function,
+        # from the process-wide cache if it's been looked up before
+        #
+        key = (self.__server_key, name)
+        function = _function_cache.get(key)
+        if function is None:
+            if '(' in name:
+                cast = 'regprocedure'
+            else:
+                cast = 'regproc'
+            result = self._execute('SELECT oid, prorettype, proargtypes FROM pg_proc WHERE oid = %s::' + cast, [name])
+            if result.error:
+                raise result.error
+            oid, rettype, argtypes = result.rows[0]
+            function = (long(oid), long(rettype), [long(t) for t in argtypes.split()])
+            _function_cache[key] = function
+        return function
+
+
+    def __numeric_conversion(self, conversion, descr):
+        #
+        # Pick the conversion for a column according to the
+        # numeric_mode of the current command
+        #
+        name = self._oid_map.get(descr[1], _DEFAULT_PGTYPE).name
+        if self.__numeric_mode == 'float':
+            if name == 'numeric':
+                return float
+            if name == '_numeric':
+                return _NUMERIC_FLOAT_ARRAY
+        elif name == 'numeric':
+            # the type modifier holds ((precision << 16) | scale) + 4
+            modifier = descr[3]
+            if (modifier >= 4) and (((modifier - 4) & 0xffff) == 0):
+                return _numeric_to_int
+        return conversion
+
+
     def __read_bytes(self, nBytes):
         #
         # Read the specified number of bytes from the backend
@@ -677,15 +2669,15 @@ class Connection(object):
         #  method the handle the rest of the response
         #
         #  PostgreSQL responses begin with a single character <c>, this
-        #  method looks up a method named _pkt_<c> and calls that
-        #  to handle the response
+        #  method looks up the method named _pkt_<c> in the dispatch
+        #  table and calls that to handle the response
         #
         pkt_type = self.__read_bytes(1)
 
-        try:
-            getattr(self, '_pkt_' + pkt_type)()
-        except AttributeError:
+        handler = self.__dispatch.get(pkt_type)
+        if handler is None:
             raise InterfaceError('Unrecognized packet type from server: %s' % pkt_type)
+        handler(self)
 
 
     def __read_row(self, ascii=True):
@@ -693,47 +2685,48 @@ class Connection(object):
         # Read an ASCII or Binary Row
         #
         result = self.__current_result
+        read_bytes = self.__read_bytes
 
-        # check if we need to use longs (more than 32 fields)
-        if result.null_byte_count > 4:
-            null_bits = 0L
-            field_mask = 128L
-        else:
-            null_bits = 0
-            field_mask = 128
-
-        # read bytes holding null bits and setup the field mask
-        # to point at the first (leftmost) field
-        if result.null_byte_count:
-            for ch in self.__read_bytes(result.null_byte_count):
-                null_bits = (null_bits << 8) | ord(ch)
-            field_mask <<= (result.null_byte_count - 1) * 8
+        # read bytes holding null bits, and expand them into
+        # a flag for each field saying whether it has data present
+        present = []
+        for ch in read_bytes(result.null_byte_count):
+            present.extend(_FIELD_PRESENCE[ord(ch)])
 
-        # read each field into a row
+        # read each field into a row (zip() drops any padding
+        # bits past the last field)
         row = []
-        for field_num in range(result.num_fields):
-            if null_bits & field_mask:
+        for has_data, convert in zip(present, result.conversion):
+            if has_data:
                 # field has data present, read what was sent
-                field_size = _unpack('!i', self.__read_bytes(4))[0]
+                field_size = _unpack('!i', read_bytes(4))[0]
                 if ascii:
                     field_size -= 4
-                data = self.__read_bytes(field_size)
-                row.append(result.conversion[field_num](data))
+                row.append(convert(read_bytes(field_size)))
             else:
                 # field has no data (is null)
                 row.append(None)
-            field_mask >>= 1
 
         result.rows.append(row)
 
 
     def __recv(self, bufsize):
+        if self.__profile is not None:
+            start = time.time()
+        if self.__deadline is not None:
+            self.__wait_deadline()
         while True:
             try:
-                return self.__socket.recv(bufsize)
+                data = self.__socket.recv(bufsize)
             except socket.error, serr:
                 if serr[0] != errno.EINTR:
                     raise
+                continue
+            if self.__stats is not None:
+                self.__stats.received(data)
+            if self.__profile is not None:
+                self.__profile.wait_time += time.time() - start
+            return data
 
 
     def _register_oid(self, oid, name):
@@ -754,19 +2747,42 @@ class Connection(object):
 
     def __send(self, data):
         #
-        # Send data to the backend, make sure it's all sent
+        # Send data to the backend along with anything already
+        # buffered, make sure it's all sent
         #
-        if self.__socket is None:
-            raise InterfaceError('Connection not open')
+        self.__write(data)
+        self.__flush()
 
-        while data:
+
+    def __wait_deadline(self):
+        #
+        # Wait for the socket to become readable, and if the deadline
+        # for the current command passes first, ask the backend to
+        # cancel it (and then carry on waiting for the response)
+        #
+        while True:
+            remaining = self.__deadline - time.time()
+            if remaining <= 0:
+                break
             try:
-                nSent = self.__socket.send(data)
-            except socket.error, serr:
+                r, _, _ = select.select([self.__socket], [], [], remaining)
+            except select.error, serr:
                 if serr[0] != errno.EINTR:
                     raise
                 continue
-            data = data[nSent:]
+            if r:
+                return
+
+        self.__deadline = None
+        self.__timed_out = True
+        try:
+            self.cancel(self.__timeout)
+        except Exception, err:
+            #
+            # Raising here would leave the rest of the response unread,
+            # so keep reading it and let _execute() report the failure
+            #
+            self.__cancel_error = err
 
 
     def __wait_response(self, timeout):
@@ -790,6 +2806,18 @@ class Connection(object):
             return 0
 
 
+    def __write(self, data):
+        #
+        # Add data to the output buffer, to be sent along with
+        # the rest of the message by __flush() or __send(), or
+        # sooner if the buffer is getting large
+        #
+        self.__output_buffer.append(data)
+        self.__output_size += len(data)
+        if self.__output_size >= _OUTPUT_BUFFER_SIZE:
+            self.__flush()
+
+
 
     #-----------------------------------
     #  Packet Handling Methods
@@ -800,29 +2828,47 @@ class Connection(object):
         # Notification Response
         #
         pid = _unpack('!i', self.__read_bytes(4))[0]
-        self.__notify_queue.append((self.__read_string(), pid))
+        name = self.__read_string()
+        self.__notify_queue.append((name, pid))
+        if self.result_cache is not None:
+            self.result_cache.invalidate(name)
 
 
     def _pkt_B(self):
         #
-        # Binary Row
+        # Binary Row, along with any more that have already
+        # arrived right behind it
         #
         self.__read_row(ascii=False)
+        while self.__input_buffer[:1] == 'B':
+            self.__input_buffer = self.__input_buffer[1:]
+            self.__read_row(ascii=False)
 
 
     def _pkt_C(self):
         #
         # Completed Response
         #
-        self.__current_result.completed = self.__read_string()
+        result = self.__current_result
+        result.completed = self.__read_string()
+        if isinstance(result.rows, _SpillingRows):
+            # Rows that all fit in memory are handed back as a plain list
+            rows = result.rows.in_memory()
+            if rows is not None:
+                result.rows = rows
         self.__new_result()
 
 
     def _pkt_D(self):
         #
-        # ASCII Row
+        # ASCII Row, along with any more that have already
+        # arrived right behind it
         #
-        self.__read_row()
+        read_row = self.__read_row
+        read_row()
+        while self.__input_buffer[:1] == 'D':
+            self.__input_buffer = self.__input_buffer[1:]
+            read_row()
 
 
     def _pkt_E(self):
@@ -852,14 +2898,28 @@ class Connection(object):
             stdin = sys.stdin
 
         lastline = None
-        while True:
-            s = stdin.readline()
-            if (not s) or (s == '\\.\n'):
-                break
-            self.__send(s)
-            lastline = s
+        try:
+            while True:
+                s = stdin.readline()
+                if (not s) or (s == '\\.\n'):
+                    break
+                self.__write(s)
+                lastline = s
+        except:
+            #
+            # Drop whatever hasn't been sent yet rather than leave it
+            # to be prepended to the next message, finish the COPY
+            # and read the backend's response so the connection stays
+            # usable, then pass the error on
+            #
+            self.__output_buffer = []
+            self.__output_size = 0
+            self.__send('\\.\n')
+            while not self.__ready:
+                self.__read_response()
+            raise
         if lastline and (lastline[-1] != '\n'):
-            self.__send('\n')
+            self.__write('\n')
         self.__send('\\.\n')
 
 
@@ -962,10 +3022,23 @@ class Connection(object):
             description.append((name, pg_type.type_id, None, None, None, None, None))
 
         # Save the field description list
-        self.__current_result.set_description(description)
+        self.__current_result.set_description(description, self.result_memory_limit)
 
         # build a list of field conversion functions we can use against each row
-        self.__current_result.conversion = [self._get_conversion(d[1]) for d in descr]
+        conversion = [self._get_conversion(d[1]) for d in descr]
+        if self.__numeric_mode != 'decimal':
+            conversion = [self.__numeric_conversion(c, d) for c, d in zip(conversion, descr)]
+        if (self.__profile is not None) or (self.__stats is not None):
+            timed = []
+            for c, d in zip(conversion, descr):
+                totals = []
+                if self.__profile is not None:
+                    totals.append(self.__profile.conversion_total(self._oid_map.get(d[1], _DEFAULT_PGTYPE).name))
+                if self.__stats is not None:
+                    totals.append(self.__stats.conversion_total())
+                timed.append(_timed_converter(c, totals))
+            conversion = timed
+        self.__current_result.conversion = conversion
 
 
     def _pkt_V(self):
@@ -992,6 +3065,13 @@ class Connection(object):
         #print 'Ready for Query'
 
 
+    #--------------------------------------
+    # Helper func for NotifyMultiplexer
+    #
+    def _notifies_pending(self):
+        return bool(self.__notify_queue or self.__input_buffer)
+
+
     #--------------------------------------
     # Helper func for _LargeObject
     #
@@ -999,12 +3079,55 @@ class Connection(object):
         return apply(self.funcall, (self.__lo_funcs[name],) + args)
 
 
+    def _lo_pipeline(self, name, arglists, depth):
+        #
+        # Generate the results of calling a Large Object function
+        # once for each tuple of args in arglists, keeping up to
+        # depth calls in flight rather than waiting for each one
+        # to finish before sending the next.  If the generator
+        # isn't run to completion, the responses to any calls
+        # still in flight are read and discarded.
+        #
+        oid = self.__lo_funcs[name]
+        in_flight = 0
+        try:
+            for args in arglists:
+                if in_flight >= depth:
+                    self.__flush()
+                    in_flight -= 1
+                    yield self.__funcall_result()
+                self.__write(self.__funcall_message(oid, args))
+                in_flight += 1
+            self.__flush()
+            while in_flight:
+                in_flight -= 1
+                yield self.__funcall_result()
+        finally:
+            if self.__output_buffer:
+                self.__flush()
+            while in_flight:
+                in_flight -= 1
+                try:
+                    self.__funcall_result()
+                except DatabaseError:
+                    pass
+
+
     #--------------------------------------
     # Helper function for Cursor objects
     #
-    def _execute(self, cmd, args=None):
+    def _execute(self, cmd, args=None, timeout=None, numeric_mode=None):
+        if numeric_mode is None:
+            numeric_mode = self.numeric_mode
+        if numeric_mode not in _NUMERIC_MODES:
+            raise InterfaceError('Unknown numeric_mode: %r' % (numeric_mode,))
+        if (timeout is not None) and (self.__address is None):
+            # There's nowhere to send a cancel request to
+            raise NotSupportedError('Timeouts need a connection opened by connect() with a host')
+
         if isinstance(cmd, unicode):
             cmd = cmd.encode('utf-8')
+        template = cmd
 
         while args is not None:
             if isinstance(args, (tuple, list)):
@@ -1020,17 +3143,90 @@ class Connection(object):
                 # in a tuple and retry
                 args = (args,)
 
+        cache = self.result_cache
+        if (numeric_mode != 'decimal') or self.__in_transaction:
+            #
+            # Cached results hold Decimal values, and inside a transaction
+            # results may depend on its own uncommitted changes (which
+            # won't be NOTIFYed until it commits)
+            #
+            cache = None
+        if cache is not None:
+            #
+            # Pick up any notifications that came in while we
+            # were idle, so they can invalidate cache entries
+            #
+            while self.__wait_response(0):
+                self.__read_response()
+            result = cache.lookup(cmd, self.__server_key)
+            if result is not None:
+                if self._query_hooks:
+                    stats = QueryStats(cmd, template)
+                    stats.cache_hit = True
+                    stats.finish(result)
+                    for hook in self._query_hooks:
+                        hook(stats)
+                return result
+            generations = cache.generations(cmd)
+
+        if self._query_hooks:
+            stats = self.__stats = QueryStats(cmd, template)
+        else:
+            stats = None
+        profile = None
+
         self.__ready = 0
         self.__result = None
         self.__new_result()
-        self.__send('Q'+cmd+'\0')
-        while not self.__ready:
-            self.__read_response()
+        self.__numeric_mode = numeric_mode
+        if timeout is not None:
+            self.__deadline = time.time() + timeout
+            self.__timeout = timeout
+        self.__timed_out = False
+        self.__cancel_error = None
+        try:
+            self.__send('Q'+cmd+'\0')
+            if stats is not None:
+                stats.send_time = time.time() - stats.start
+            if self.profiler is not None:
+                profile = self.__profile = self.profiler.sample()
+            while not self.__ready:
+                self.__read_response()
+        finally:
+            self.__deadline = None
+            self.__timeout = None
+            self.__stats = None
+            self.__profile = None
         result, self.__result = self.__result[:-1], None
-
-        # Convert old-style results to what the new Cursor class expects
-        result = result[0]
-        result.query = cmd
+        if profile is not None:
+            self.profiler.add(profile)
+
+        for r in result:
+            if r.completed in _TRANSACTION_START_TAGS:
+                self.__in_transaction = True
+            elif r.completed in _TRANSACTION_END_TAGS:
+                self.__in_transaction = False
+
+        if self.__cancel_error is not None:
+            err, self.__cancel_error = self.__cancel_error, None
+            raise OperationalError('Command timed out and could not be cancelled: %s' % err)
+
+        if self.__timed_out:
+            for r in result:
+                if r.error:
+                    r.error = PostgreSQL_QueryTimeout(*r.error.args)
+
+        # Convert old-style results to what the new Cursor class expects,
+        # the first ResultSet carrying those of any following statements
+        for r in result:
+            r.query = cmd
+        result, result.following = result[0], result[1:]
+        if stats is not None:
+            stats.finish(result)
+            for hook in self._query_hooks:
+                hook(stats)
+        if (cache is not None) and not result.following:
+            cache.store(cmd, result, self.__server_key, generations)
         return result
 
 
@@ -1050,7 +3246,7 @@ class Connection(object):
         self.register_pgsql(['int2', 'int4'], int, NUMBER)
         self.register_pgsql('int8', long, NUMBER)
         self.register_pgsql(['float4', 'float8'], float, NUMBER)
-        self.register_pgsql('numeric', Decimal, NUMBER)
+        self.register_pgsql('numeric', _numeric_to_python, NUMBER)
 
         self.register_pgsql('oid', long, ROWID)
         self.register_pgsql('bool', _bool_to_python, 'bool')
@@ -1059,6 +3255,30 @@ class Connection(object):
         self.register_pgsql(['time', 'timetz'], _time_to_python, DATETIME)
         self.register_pgsql(['timestamp', 'timestamptz'],
             _timestamp_to_python, DATETIME)
+        self.register_pgsql('interval', _interval_to_python, DATETIME)
+
+        self.register_pgsql('uuid', uuid.UUID, STRING)
+        if ipaddress is not None:
+            self.register_pgsql('inet', _inet_to_python, STRING)
+            self.register_pgsql('cidr', _cidr_to_python, STRING)
+        if json is not None:
+            self.register_pgsql(['json', 'jsonb'], LazyJSON, STRING)
+
+        self.register_pgsql(['_char', '_varchar', '_text', '_bpchar', '_name'],
+            _array_converter(_char_to_python), 'array')
+        self.register_pgsql('_bytea', _array_converter(_binary_to_python), 'array')
+        self.register_pgsql('_int2', _array_converter(int, 'h'), 'array')
+        self.register_pgsql('_int4', _array_converter(int, 'i'), 'array')
+        self.register_pgsql('_int8', _array_converter(long, _INT8_TYPECODE), 'array')
+        self.register_pgsql('_float4', _array_converter(float, 'd'), 'array')
+        self.register_pgsql('_float8', _array_converter(float, 'd'), 'array')
+        self.register_pgsql('_numeric', _array_converter(_numeric_to_python), 'array')
+        self.register_pgsql('_oid', _array_converter(long, 'L'), 'array')
+        self.register_pgsql('_bool', _array_converter(_bool_to_python), 'array')
+        self.register_pgsql('_date', _array_converter(_date_to_python), 'array')
+        self.register_pgsql(['_time', '_timetz'], _array_converter(_time_to_python), 'array')
+        self.register_pgsql(['_timestamp', '_timestamptz'],
+            _array_converter(_timestamp_to_python), 'array')
 
         #
         ## Map Python -> PgSQL
@@ -1068,13 +3288,67 @@ class Connection(object):
         self.register_python(datetime.datetime, _datetime_to_pgsql)
         self.register_python(datetime.date, lambda x: "'%s'::date" % str(x))
         self.register_python(datetime.time, _time_to_pgsql)
+        self.register_python(datetime.timedelta, _timedelta_to_pgsql)
+        self.register_python(uuid.UUID, lambda x: "'%s'::uuid" % x)
+        if ipaddress is not None:
+            self.register_python(ipaddress.IPv4Network, lambda x: "'%s'::cidr" % x)
+            self.register_python(ipaddress.IPv6Network, lambda x: "'%s'::cidr" % x)
+            self.register_python(ipaddress.IPv4Address, lambda x: "'%s'::inet" % x)
+            self.register_python(ipaddress.IPv6Address, lambda x: "'%s'::inet" % x)
         self.register_python(Binary, _binary_to_pgsql)
 
+        # Items of lists and tuples are converted by this connection,
+        # referred to through a proxy because a bound method would make
+        # a reference cycle, keeping __del__ from ever being called
+        cnx = weakref.proxy(self)
+        self.register_python(list, lambda x: _list_to_pgsql(x, cnx._python_to_sql))
+        self.register_python(tuple, lambda x: _tuple_to_pgsql(x, cnx._python_to_sql))
+
 
     #--------------------------------------
     # Public methods
     #
 
+    def add_query_hook(self, hook):
+        """
+        Register a callable to be called as hook(stats) after each
+        command sent to the backend completes, where stats is a QueryStats
+        object describing where the time went.
+
+        """
+        self._query_hooks.append(hook)
+
+
+    def cancel(self, timeout=None):
+        """
+        Ask the backend to cancel the command it's currently executing,
+        by sending a cancel request over a separate connection.  Safe to
+        call from another thread.  The cancelled command fails with a
+        DatabaseError, unless it happens to finish first.
+
+        If timeout is not None, it's a number of floating-point seconds
+        to allow for sending the request, after which OperationalError
+        is raised.
+
+        """
+        if self.__backend_pid is None:
+            raise InterfaceError('No backend key available to cancel with')
+        if self.__address is None:
+            raise InterfaceError('No backend address available to cancel with')
+
+        s = socket.socket(self.__address[0], socket.SOCK_STREAM)
+        try:
+            s.settimeout(timeout)
+            s.connect(self.__address[1])
+            s.sendall(_pack('!iiii', 16, 80877102, self.__backend_pid, self.__backend_key))
+            # The backend closes the connection once it's handled the request
+            s.recv(1)
+        except socket.timeout:
+            raise OperationalError('Timed out sending cancel request')
+        finally:
+            s.close()
+
+
     def close(self):
         """
         Close the connection now (rather than whenever __del__ is
@@ -1098,12 +3372,60 @@ class Connection(object):
         self._execute('COMMIT')
 
 
-    def cursor(self):
+    def cursor(self):
+        """
+        Get a new cursor object using this connection.
+
+        """
+        return Cursor(self)
+
+
+    def fastcall(self, name, *args):
+        """
+        Call the named PostgreSQL function directly, without parsing
+        a SQL command, and return its result.  name may include
+        argument types (for example 'my_func(int4, text)') to pick
+        one of several functions with the same name.  Functions are
+        looked up once per process, and the descriptions cached.
+
+        Arguments and results may be of types bool, bytea, float4,
+        float8, int2, int4, int8, oid, and the text types, and
+        results may also be void.  NULL arguments aren't supported.
+
+        """
+        oid, rettype, argtypes = self.__lookup_function(name)
+        if len(args) != len(argtypes):
+            raise ProgrammingError('%s takes %d arguments (%d given)' % (name, len(argtypes), len(args)))
+
+        encoded = []
+        for arg, argtype in zip(args, argtypes):
+            if arg is None:
+                raise NotSupportedError('NULL arguments are not supported by fastcall')
+            encoded.append(self.__binary_conversion(_BINARY_ENCODERS, argtype)(arg))
+        decode = self.__binary_conversion(_BINARY_DECODERS, rettype)
+
+        try:
+            result = apply(self.funcall, (oid,) + tuple(encoded))
+        except DatabaseError:
+            # The function may have been dropped or replaced since
+            # it was looked up, so look it up again next time
+            _function_cache.pop((self.__server_key, name), None)
+            raise
+
+        if result is None:
+            return None
+        return decode(result)
+
+
+    def fileno(self):
         """
-        Get a new cursor object using this connection.
+        Return the file descriptor of the socket connected to the
+        backend, for use with select() and friends.
 
         """
-        return Cursor(self)
+        if self.__socket is None:
+            raise InterfaceError('Connection not open')
+        return self.__socket.fileno()
 
 
     def funcall(self, oid, *args):
@@ -1113,23 +3435,29 @@ class Connection(object):
         ints or strings.
 
         """
-        self.__ready = 0
-        self.__send(_pack('!2sIi', 'F\0', oid, len(args)))
-        for arg in args:
-            atype = type(arg)
-            if (atype == types.LongType) and (arg >= 0):
-                # Make sure positive longs, such as OIDs, get
-                # sent back as unsigned ints
-                self.__send(_pack('!iI', 4, arg))
-            elif (atype == types.IntType) or (atype == types.LongType):
-                self.__send(_pack('!ii', 4, arg))
-            else:
-                self.__send(_pack('!i', len(arg)))
-                self.__send(arg)
+        self.__send(self.__funcall_message(oid, args))
+        return self.__funcall_result()
 
-        while not self.__ready:
+
+    def get_notifies(self, timeout=0):
+        """
+        Return a list of (name, pid) tuples for all the async
+        notifications received from the backend so far (in the order
+        they arrived), clearing them from the queue.
+
+        If none are queued, waits up to timeout floating-point seconds
+        for something to arrive from the backend, -1 means no timeout.
+        Anything else already sent by the backend is read without
+        waiting further.  An empty list means nothing arrived.
+
+        """
+        if (not self.__notify_queue) and self.__wait_response(timeout):
             self.__read_response()
-        result, self.__func_result = self.__func_result, None
+        while self.__wait_response(0):
+            self.__read_response()
+
+        result = list(self.__notify_queue)
+        self.__notify_queue.clear()
         return result
 
 
@@ -1144,6 +3472,65 @@ class Connection(object):
         return _unpack('!i', r)[0]
 
 
+    def lo_export(self, oid, path):
+        """
+        Write the contents of the Large Object with the specified
+        oid to a local file, return the number of bytes written.
+        Like other Large Object operations, must be called within
+        a transaction.
+
+        """
+        import mmap
+        lobj = self.lo_open(oid, INV_READ)
+        try:
+            lobj.seek(0, SEEK_END)
+            size = lobj.tell()
+            lobj.seek(0, SEEK_SET)
+
+            f = open(path, 'w+b')
+            try:
+                if not size:
+                    # can't map an empty file
+                    return 0
+                f.truncate(size)
+                m = mmap.mmap(f.fileno(), size)
+                try:
+                    return lobj.readinto(m)
+                finally:
+                    m.close()
+            finally:
+                f.close()
+        finally:
+            lobj.close()
+
+
+    def lo_import(self, path):
+        """
+        Create a new Large Object holding the contents of a local
+        file, return its oid.  Like other Large Object operations,
+        must be called within a transaction.
+
+        """
+        import mmap
+        f = open(path, 'rb')
+        try:
+            oid = self.lo_create()
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    lobj = self.lo_open(oid, INV_WRITE)
+                    try:
+                        lobj.copy_from_file(m)
+                    finally:
+                        lobj.close()
+                finally:
+                    m.close()
+        finally:
+            f.close()
+        return oid
+
+
     def lo_open(self, oid, mode=INV_READ|INV_WRITE):
         """
         Open the Large Object with the specified oid, returns
@@ -1215,6 +3602,14 @@ class Connection(object):
         self._python_converters.append((klass, converter))
 
 
+    def remove_query_hook(self, hook):
+        """
+        Unregister a callable added with add_query_hook()
+
+        """
+        self._query_hooks.remove(hook)
+
+
     def rollback(self):
         """
         Cause the the database to roll back to the start of any
@@ -1249,8 +3644,7 @@ class Connection(object):
         """
         while True:
             if self.__notify_queue:
-                result, self.__notify_queue = self.__notify_queue[0], self.__notify_queue[1:]
-                return result
+                return self.__notify_queue.popleft()
             if self.__wait_response(timeout):
                 self.__read_response()
             else:
@@ -1277,6 +3671,13 @@ Connection.DataError = DataError
 Connection.NotSupportedError = NotSupportedError
 
 
+#
+# Forward-only cursors delete consumed rows from the front of their
+# list once there are at least this many, and they make up half of it
+#
+_CURSOR_COMPACT_ROWS = 1024
+
+
 class Cursor(object):
     """
     Cursor objects are created by calling a connection's cursor() method,
@@ -1302,8 +3703,22 @@ class Cursor(object):
         self.rowcount = -1
         self.rownumber = None
         self.__rows = None
+        self.__offset = 0
+        self.__forward_only = False
+        self.__sets = None
         self.query = ''
 
+        #
+        # Overrides the connection's numeric_mode if not None
+        #
+        self.numeric_mode = None
+
+        #
+        # If true, results of commands executed from then on let go
+        # of rows as they're fetched, and can't be scrolled backwards
+        #
+        self.forward_only = False
+
 
     def __iter__(self):
         """
@@ -1324,7 +3739,7 @@ class Cursor(object):
         self.__init__(None)
 
 
-    def execute(self, cmd, args=None):
+    def execute(self, cmd, args=None, timeout=None):
         """
         Execute a database operation (query or command).
         Parameters may be provided as sequence or
@@ -1332,16 +3747,55 @@ class Cursor(object):
         in the operation. Variables are specified in format (...WHERE foo=%s...)
         or pyformat (...WHERE foo=%(name)s...) paramstyles.
 
+        If timeout is specified, it's a number of floating-point seconds
+        after which the command is cancelled, and PostgreSQL_QueryTimeout
+        raised.
+
         """
+        self.__reset()
+        self.__sets = None
+
+        result = self.connection._execute(cmd, args, timeout, self.numeric_mode)
+
+        self.__sets = result.following
+        self.__set_result(result)
+
+
+    def __reset(self):
+        #
+        # Forget the current result set
+        #
         self.rowcount = -1
         self.rownumber = None
         self.description = None
         self.lastrowid = None
         self.__rows = None
+        self.__offset = 0
         self.messages = []
 
-        result = self.connection._execute(cmd, args)
 
+    def __release(self, start, stop):
+        #
+        # Drop a forward-only cursor's references to the rows it just
+        # fetched, start..stop-1 in its list.  Once the consumed rows
+        # make up half the list they're deleted from the front, so
+        # the cost of moving the rest down is amortized.
+        #
+        rows = self.__rows
+        if (stop >= _CURSOR_COMPACT_ROWS) and (stop + stop >= len(rows)):
+            del rows[:stop]
+            self.__offset += stop
+        elif stop - start == 1:
+            rows[start] = None
+        elif stop > start:
+            rows[start:stop] = [None] * (stop - start)
+
+
+    def __set_result(self, result):
+        #
+        # Make a ResultSet the current one, raising its
+        # error if the statement failed
+        #
         if result.error:
             raise result.error
 
@@ -1365,6 +3819,9 @@ class Cursor(object):
             self.rowcount = len(self.__rows)
             self.rownumber = 0
 
+        # Rows spilled to disk don't take up memory anyway
+        self.__forward_only = self.forward_only and isinstance(self.__rows, list)
+
 
     def executemany(self, cmd,  seq_of_parameters):
         """
@@ -1422,7 +3879,23 @@ class Cursor(object):
 
         n = self.rownumber
         self.rownumber += size
-        return self.__rows[n:self.rownumber]
+        if not self.__forward_only:
+            return self.__rows[n:self.rownumber]
+
+        rows = self.__rows
+        start = n - self.__offset
+        stop = self.rownumber - self.__offset
+        if stop >= len(rows):
+            # Everything that's left, hand over the list itself
+            # rather than copying it
+            del rows[:start]
+            self.__rows = []
+            self.__offset = self.rowcount
+            return rows
+
+        result = rows[start:stop]
+        self.__release(start, stop)
+        return result
 
 
     def next(self):
@@ -1440,7 +3913,39 @@ class Cursor(object):
             raise StopIteration
 
         self.rownumber += 1
-        return self.__rows[n]
+        if not self.__forward_only:
+            return self.__rows[n]
+
+        n -= self.__offset
+        row = self.__rows[n]
+        self.__release(n, n+1)
+        return row
+
+
+    def nextset(self):
+        """
+        Make the cursor skip to the next available result set, when
+        the command executed consisted of several statements separated
+        by semicolons, discarding any remaining rows from the current
+        set.  Returns None if there are no more sets, otherwise True.
+
+        Each set has its own description, rowcount and messages.  If the
+        statement that would have produced the next set failed, its
+        error is raised (PostgreSQL doesn't run any statements after
+        one that fails, so there are no more sets after that).
+
+        """
+        if self.__sets is None:
+            raise Error('No result set available')
+
+        self.__reset()
+        if not self.__sets:
+            self.__sets = []
+            return None
+
+        result = self.__sets.pop(0)
+        self.__set_result(result)
+        return True
 
 
     def scroll(self, n, mode='relative'):
@@ -1455,6 +3960,9 @@ class Cursor(object):
         An IndexError will be raised in case a scroll operation would
         leave the result set. In this case, the cursor position unchanged.
 
+        Forward-only cursors raise NotSupportedError if asked to scroll
+        backwards, skipped rows are dropped.
+
         """
         if self.__rows is None:
             raise Error('No result set available')
@@ -1469,6 +3977,11 @@ class Cursor(object):
         if (newpos < 0) or (newpos >= self.rowcount):
             raise IndexError('scroll(%d, "%s") target position: %d outsize of range: 0..%d' % (n, mode, newpos, self.rowcount-1))
 
+        if self.__forward_only:
+            if newpos < self.rownumber:
+                raise NotSupportedError('Forward-only cursors can\'t scroll backwards')
+            self.__release(self.rownumber - self.__offset, newpos - self.__offset)
+
         self.rownumber = newpos
 
 
@@ -1494,8 +4007,526 @@ class Cursor(object):
         pass
 
 
+class LargeObjectTransfer(object):
+    """
+    Move many Large Objects to or from local files in parallel,
+    spreading the work across several connections, each used by
+    its own thread.  Each object is transferred in a transaction of
+    its own, using the pipelined Large Object streaming methods, so
+    memory use is bounded by the number of workers.
+
+    connect is a callable returning a new Connection (for example:
+    lambda: bpgsql.connect(dsn)), called once per worker.  If progress
+    is not None, it's called as progress(done, total, job) after each
+    object is transferred (or fails), one call at a time.
+
+    If any transfers fail, the rest are still carried out and then
+    the first exception is raised.  A worker whose connection breaks
+    carries on with a new one, and jobs left undone because no
+    connection could be made count as failures.  The '.results' and
+    '.errors' attributes hold the outcome of the most recent run: a
+    list with the result for each job (None for failures), and a list
+    of (job, exception) tuples (job is None for failed connects).
+
+    """
+    def __init__(self, connect, workers=4, progress=None):
+        self.connect = connect
+        self.workers = workers
+        self.progress = progress
+        self.results = []
+        self.errors = []
+
+
+    def __run(self, func, jobs):
+        #
+        # Call func(cnx, job) for each job, on worker threads each
+        # with its own connection, and return a list of the results
+        #
+        jobs = list(jobs)
+        pending = iter(enumerate(jobs))
+        lock = threading.Lock()
+        done = [0]
+        self.results = [None] * len(jobs)
+        finished = [False] * len(jobs)
+        self.errors = []
+
+        def close(cnx):
+            try:
+                cnx.close()
+            except Exception:
+                pass
+
+        def worker():
+            cnx = None
+            try:
+                while True:
+                    if cnx is None:
+                        try:
+                            cnx = self.connect()
+                        except Exception, e:
+                            lock.acquire()
+                            self.errors.append((None, e))
+                            lock.release()
+                            return
+
+                    lock.acquire()
+                    try:
+                        try:
+                            i, job = pending.next()
+                        except StopIteration:
+                            return
+                    finally:
+                        lock.release()
+
+                    try:
+                        cnx._execute('BEGIN')
+                        result = func(cnx, job)
+                        cnx.commit()
+                    except Exception, e:
+                        try:
+                            cnx.rollback()
+                        except Exception:
+                            # The connection is broken, use a new one
+                            # for the next job
+                            close(cnx)
+                            cnx = None
+                        result = None
+                        error = e
+                    else:
+                        error = None
+
+                    lock.acquire()
+                    try:
+                        self.results[i] = result
+                        finished[i] = True
+                        if error is not None:
+                            self.errors.append((job, error))
+                        done[0] += 1
+                        if self.progress is not None:
+                            self.progress(done[0], len(jobs), job)
+                    finally:
+                        lock.release()
+            finally:
+                if cnx is not None:
+                    close(cnx)
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.workers, len(jobs)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        #
+        # Jobs left over because every worker failed to connect
+        #
+        for i, job in enumerate(jobs):
+            if not finished[i]:
+                self.errors.append((job, OperationalError('No connection available to transfer %r' % (job,))))
+
+        if self.errors:
+            raise self.errors[0][1]
+        return self.results
+
+
+    def export_files(self, jobs):
+        """
+        Write Large Objects to local files, jobs is a sequence of
+        (oid, path) tuples.  Returns a list of the number of bytes
+        written to each file.
+
+        """
+        return self.__run(lambda cnx, job: cnx.lo_export(*job), jobs)
+
+
+    def import_files(self, paths):
+        """
+        Create a new Large Object from each of a sequence of local
+        file paths, return a list of their oids.
+
+        """
+        return self.__run(lambda cnx, path: cnx.lo_import(path), paths)
+
+
+class NotifyListener(object):
+    """
+    Listen for asynchronous notifications on a dedicated connection,
+    and hand them to callbacks registered for each notification name.
+
+    Notifications are dispatched either from a background thread
+    started with start(), or by calling dispatch() from an event loop
+    when fileno() is readable.  Repeated notifications with the same
+    name that arrive together are coalesced, so a callback is called
+    once per burst rather than once per NOTIFY.
+
+    Arguments are the same as for the connect() function.
+
+    """
+    #
+    # Seconds the background thread waits for notifications before
+    # checking whether it's been asked to stop
+    #
+    poll_interval = 0.5
+
+    #
+    # Longest the background thread waits between attempts to reconnect
+    # after the connection fails (starting at poll_interval and doubling)
+    #
+    max_reconnect_interval = 30.0
+
+    def __init__(self, *args, **kwargs):
+        self.__connect_args = (args, kwargs)
+        self.connection = connect(*args, **kwargs)
+        self.__callbacks = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__running = False
+
+
+    def __receive(self, timeout):
+        #
+        # Wait up to timeout seconds for notifications, and return a
+        # list of the distinct (name, pid) pairs received, along with
+        # a copy of the callbacks registered at the time
+        #
+        if timeout < 0:
+            deadline = None
+        else:
+            deadline = time.time() + timeout
+
+        while True:
+            self.__lock.acquire()
+            try:
+                notifies = self.connection.get_notifies(0)
+                callbacks = self.__callbacks.copy()
+            finally:
+                self.__lock.release()
+            if notifies:
+                break
+
+            wait = self.poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    break
+
+            #
+            # Wait without holding the lock, so listen() and unlisten()
+            # from other threads aren't held up.  Waking up every
+            # poll_interval picks up anything they left buffered.
+            #
+            try:
+                select.select([self.connection], [], [], wait)
+            except select.error, serr:
+                if serr[0] != errno.EINTR:
+                    raise
+
+        # Coalesce repeats, keeping the order names first arrived in
+        # and the pid of the latest one
+        names = []
+        pids = {}
+        for name, pid in notifies:
+            if name not in pids:
+                names.append(name)
+            pids[name] = pid
+        return [(name, pids[name]) for name in names], callbacks
+
+
+    def __reconnect(self):
+        #
+        # Replace a failed connection with a new one listening for the
+        # same names, waiting longer after each attempt that fails
+        #
+        interval = self.poll_interval
+        while self.__running:
+            deadline = time.time() + interval
+            while self.__running and (time.time() < deadline):
+                time.sleep(min(self.poll_interval, max(deadline - time.time(), 0)))
+            if not self.__running:
+                return
+
+            cnx = None
+            try:
+                cnx = connect(*self.__connect_args[0], **self.__connect_args[1])
+                self.__lock.acquire()
+                try:
+                    for name in self.__callbacks:
+                        cnx.cursor().execute('LISTEN "%s"' % name.replace('"', '""'))
+                    old, self.connection = self.connection, cnx
+                finally:
+                    self.__lock.release()
+            except:
+                self.handle_error()
+                if cnx is not None:
+                    try:
+                        cnx.close()
+                    except:
+                        pass
+                interval = min(interval * 2, self.max_reconnect_interval)
+                continue
+
+            try:
+                old.close()
+            except:
+                pass
+            return
+
+
+    def __run(self):
+        while self.__running:
+            try:
+                notifies, callbacks = self.__receive(self.poll_interval)
+            except:
+                #
+                # The connection failed, report it once and try a new
+                # one rather than failing again straight away
+                #
+                if self.__running:
+                    self.handle_error()
+                    self.__reconnect()
+                continue
+
+            for name, pid in notifies:
+                for callback in callbacks.get(name, ()):
+                    try:
+                        callback(name, pid)
+                    except:
+                        self.handle_error()
+
+
+    def close(self):
+        """
+        Stop the background thread if it's running, and close the
+        connection.
+
+        """
+        self.stop()
+        self.connection.close()
+
+
+    def dispatch(self, timeout=0):
+        """
+        Wait up to timeout seconds (-1 means no timeout) for
+        notifications, and call the callbacks registered for them
+        as callback(name, pid), once for each distinct name received.
+        Returns the number of callbacks called.
+
+        """
+        notifies, callbacks = self.__receive(timeout)
+        count = 0
+        for name, pid in notifies:
+            for callback in callbacks.get(name, ()):
+                callback(name, pid)
+                count += 1
+        return count
+
+
+    def fileno(self):
+        """
+        Return the file descriptor of the listening connection.
+
+        """
+        return self.connection.fileno()
+
+
+    def handle_error(self):
+        """
+        Called by the background thread when a callback raises an
+        exception, or when the connection fails (after which it waits
+        and reconnects, calling this again for each attempt that
+        fails).  By default prints the traceback and carries on.
+        Subclasses may want to override this.
+
+        """
+        import traceback
+        traceback.print_exc()
+
+
+    def listen(self, name, callback):
+        """
+        Arrange for callback(name, pid) to be called when a notification
+        for 'name' arrives, issuing a LISTEN if this is the first callback
+        for that name.
+
+        """
+        self.__lock.acquire()
+        try:
+            if name not in self.__callbacks:
+                self.connection.cursor().execute('LISTEN "%s"' % name.replace('"', '""'))
+                self.__callbacks[name] = []
+            self.__callbacks[name].append(callback)
+        finally:
+            self.__lock.release()
+
+
+    def start(self):
+        """
+        Start dispatching notifications from a background daemon thread.
+
+        """
+        if self.__thread is not None:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+
+    def stop(self):
+        """
+        Stop the background thread, waiting for it to finish.
+
+        """
+        if self.__thread is None:
+            return
+        self.__running = False
+        self.__thread.join()
+        self.__thread = None
+
+
+    def unlisten(self, name, callback=None):
+        """
+        Remove a callback (or all callbacks if none is specified) for
+        a notification name, issuing an UNLISTEN if none remain.
+
+        """
+        self.__lock.acquire()
+        try:
+            callbacks = self.__callbacks.get(name, [])
+            if callback is None:
+                del callbacks[:]
+            elif callback in callbacks:
+                callbacks.remove(callback)
+            if (name in self.__callbacks) and not callbacks:
+                self.connection.cursor().execute('UNLISTEN "%s"' % name.replace('"', '""'))
+                del self.__callbacks[name]
+        finally:
+            self.__lock.release()
+
+
+class NotifyMultiplexer(object):
+    """
+    Wait for async notifications on many connections at once from a
+    single thread, using epoll() where it's available (falling back
+    to poll() or select()).
+
+    """
+    def __init__(self):
+        self.__connections = {}
+        self.__milliseconds = False
+        if hasattr(select, 'epoll'):
+            self.__poller = select.epoll()
+            self.__flags = select.EPOLLIN
+        elif hasattr(select, 'poll'):
+            self.__poller = select.poll()
+            self.__flags = select.POLLIN
+            self.__milliseconds = True
+        else:
+            self.__poller = None
+
+
+    def __poll(self, timeout):
+        #
+        # Return a list of file descriptors that are ready to be read
+        #
+        if self.__poller is None:
+            if timeout < 0:
+                timeout = None
+            r, _, _ = select.select(self.__connections.keys(), [], [], timeout)
+            return r
+
+        if self.__milliseconds:
+            if timeout >= 0:
+                timeout = int(timeout * 1000)
+            else:
+                timeout = None
+        while True:
+            try:
+                return [fd for fd, event in self.__poller.poll(timeout)]
+            except (select.error, IOError), err:
+                if err.args[0] != errno.EINTR:
+                    raise
+
+
+    def __read(self, conn, result):
+        #
+        # Add a connection's notifications to the result list.  If the
+        # connection has failed, it's added as (conn, None, None) rather
+        # than letting one broken connection stop the others being read.
+        #
+        try:
+            notifies = conn.get_notifies()
+        except (Error, socket.error):
+            result.append((conn, None, None))
+        else:
+            result.extend([(conn, name, pid) for name, pid in notifies])
+
+
+    def close(self):
+        """
+        Stop watching all connections (without closing them).
+
+        """
+        if hasattr(self.__poller, 'close'):
+            self.__poller.close()
+        self.__poller = None
+        self.__connections = {}
+
+
+    def register(self, conn):
+        """
+        Start watching a connection for notifications.  The connection
+        should have already issued a LISTEN for whatever it's interested
+        in, and shouldn't be used for anything else by other threads.
+
+        """
+        fd = conn.fileno()
+        self.__connections[fd] = conn
+        if self.__poller is not None:
+            self.__poller.register(fd, self.__flags)
+
+
+    def unregister(self, conn):
+        """
+        Stop watching a connection.
+
+        """
+        fd = conn.fileno()
+        del self.__connections[fd]
+        if self.__poller is not None:
+            self.__poller.unregister(fd)
+
+
+    def wait(self, timeout=-1):
+        """
+        Wait up to timeout floating-point seconds (-1 means no timeout)
+        for notifications to arrive on any of the registered connections.
+
+        Returns a list of (connection, name, pid) tuples, which is empty
+        if the timeout expired.  A connection that failed while being
+        read (for example because the backend went away) is returned
+        as (connection, None, None), calling its get_notifies() raises
+        the error again, and it should be unregistered.
+
+        """
+        result = []
+
+        #
+        # Connections may have already read some notifications (for example
+        # while executing a command), which the poller won't know about
+        #
+        for conn in self.__connections.values():
+            if conn._notifies_pending():
+                self.__read(conn, result)
+        if result:
+            return result
+
+        for fd in self.__poll(timeout):
+            self.__read(self.__connections[fd], result)
+        return result
+
+
 def connect(dsn=None, username='', password='',
-            host=None, dbname='', port='', opt='', **extra):
+            host=None, dbname='', port='', opt='', record=None, sock=None, **extra):
     """
     Connect to a PostgreSQL database.
 
@@ -1509,7 +4540,12 @@ def connect(dsn=None, username='', password='',
 
           cnx = bpgsql.connect("host=127.0.0.1 dbname=mydb user=jake")
 
+    If record is a filename or file object, all the bytes sent to and
+    received from the backend are logged to it, and the log may later
+    be played back by passing sock=ReplaySocket(filename).  Otherwise
+    sock may be an already-connected socket to use.
+
     """
-    return Connection(dsn, username, password, host, dbname, port, opt)
+    return Connection(dsn, username, password, host, dbname, port, opt, record, sock)
 
 # ---- EOF ----
@@ -81,7 +81,7 @@ class ConnectionWrapper(bpgsql.Connection):
         self.django_needs_begin = True
         bpgsql.Connection.__init__(self, *args, **kwargs)
 
-    def _execute(self, cmd, args=None):
+    def _execute(self, cmd, args=None, timeout=None, numeric_mode=None):
         operation = cmd.split(' ', 1)[0].lower()
         if self.django_needs_begin and operation in WRAPPED_OPS:
             bpgsql.Connection._execute(self, 'BEGIN')
@@ -92,7 +92,7 @@ class ConnectionWrapper(bpgsql.Connection):
             debuglog('>>FORCED COMMIT\n')
             self.django_needs_begin = True
 
-        result = bpgsql.Connection._execute(self, cmd, args)
+        result = bpgsql.Connection._execute(self, cmd, args, timeout, numeric_mode)
 
         # Django expects some DatabaseErrors to be more specifically
         # identified as IntegrityErrors, If the word 'violates' is in
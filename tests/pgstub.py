@@ -0,0 +1,728 @@
+#!/usr/bin/env python
+"""
+Fake PostgreSQL server, speaking enough of the version 2.0
+frontend/backend protocol for bpgsql to connect and run commands
+against it, so tests and benchmarks can run without a real database.
+
+Understands startup and password authentication, simple queries
+(returning canned or synthetic results), COPY in and out, function
+calls for the Large Object functions (and any added with
+add_function()), LISTEN/NOTIFY, and cancel requests.  For example:
+
+    server = StubServer()
+    server.add_result('SELECT * FROM foo',
+        Result([('id', 'int4'), ('name', 'text')], [['1', 'one'], ['2', None]]))
+    cnx = bpgsql.connect(server.dsn)
+    ...
+    server.close()
+
+"""
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from struct import pack, unpack
+
+#
+# Builtin types the server reports in pg_type, (oid, name)
+#
+TYPES = [
+    (16, 'bool'), (17, 'bytea'), (18, 'char'), (19, 'name'), (20, 'int8'),
+    (21, 'int2'), (23, 'int4'), (25, 'text'), (26, 'oid'), (30, 'oidvector'), (114, 'json'),
+    (650, 'cidr'), (700, 'float4'), (701, 'float8'), (705, 'unknown'),
+    (869, 'inet'), (1000, '_bool'), (1005, '_int2'), (1007, '_int4'),
+    (1009, '_text'), (1015, '_varchar'), (1016, '_int8'), (1021, '_float4'),
+    (1022, '_float8'), (1042, 'bpchar'), (1043, 'varchar'), (1082, 'date'),
+    (1083, 'time'), (1114, 'timestamp'), (1184, 'timestamptz'),
+    (1186, 'interval'), (1231, '_numeric'), (1266, 'timetz'),
+    (1700, 'numeric'), (2278, 'void'), (2950, 'uuid'), (3802, 'jsonb'),
+    ]
+TYPE_OIDS = dict([(name, oid) for oid, name in TYPES])
+
+#
+# Large Object functions the server implements, (oid, name)
+#
+LO_FUNCTIONS = [
+    (715, 'lo_create'), (952, 'lo_open'), (953, 'lo_close'), (954, 'loread'),
+    (955, 'lowrite'), (956, 'lo_lseek'), (957, 'lo_creat'), (958, 'lo_tell'),
+    (964, 'lo_unlink'),
+    ]
+
+#
+# Functions returning text representations of sample values
+# of various types, for building synthetic results
+#
+SAMPLE_VALUES = {
+    'bool': lambda i: 'tf'[i & 1],
+    'bytea': lambda i: '\\000abc\\377%d' % i,
+    'date': lambda i: '2008-06-%02d' % (i % 28 + 1),
+    'float8': lambda i: '%d.25' % i,
+    'int2': lambda i: str(i % 32768),
+    'int4': str,
+    'int8': lambda i: str(i * 1000000007),
+    'numeric': lambda i: '%d.%02d' % (i, i % 100),
+    'text': lambda i: 'row number %d' % i,
+    'time': lambda i: '10:%02d:%02d.123456' % (i % 60, i % 60),
+    'timestamp': lambda i: '2008-06-11 10:%02d:%02d.123456' % (i % 60, i % 60),
+    'timestamptz': lambda i: '2008-06-11 10:%02d:%02d.123456-05' % (i % 60, i % 60),
+    'varchar': lambda i: 'v%d' % i,
+    }
+
+CANCEL_REQUEST_CODE = 80877102
+
+
+class Error(object):
+    """
+    Error response to send for a command.
+
+    """
+    def __init__(self, message):
+        self.message = message
+
+
+class Result(object):
+    """
+    Result to send for a command.  'columns' is a list of (name, typename)
+    or (name, typename, type_modifier) tuples (empty for commands that
+    don't return rows), 'rows' a list of
+    lists of strings holding the text representation of each value (or
+    None for NULL), and 'tag' the command-completed tag.
+
+    """
+    def __init__(self, columns=(), rows=(), tag='SELECT'):
+        self.columns = list(columns)
+        self.rows = rows
+        self.tag = tag
+        self.__encoded = None
+
+
+    def encode(self):
+        """
+        Return the protocol messages for this result (without the
+        command-completed message), worked out only once so that
+        serving big results doesn't cost much.
+
+        """
+        if self.__encoded is None:
+            if not self.columns:
+                self.__encoded = ''
+            else:
+                parts = ['P', 'blank\0', 'T', pack('!h', len(self.columns))]
+                for column in self.columns:
+                    name, typename = column[:2]
+                    modifier = (column[2:] or (-1,))[0]
+                    parts.append(name + '\0')
+                    parts.append(pack('!ihi', TYPE_OIDS.get(typename, 705), -1, modifier))
+                for row in self.rows:
+                    parts.append(encode_row(row))
+                self.__encoded = ''.join(parts)
+        return self.__encoded
+
+
+def encode_row(row):
+    """
+    Encode a list of strings (or None for NULL) as an ASCII Row message
+
+    """
+    bits = 0
+    fields = []
+    for value in row:
+        bits <<= 1
+        if value is not None:
+            bits |= 1
+            fields.append(pack('!i', len(value) + 4))
+            fields.append(value)
+    nbytes = (len(row) + 7) >> 3
+    bits <<= nbytes * 8 - len(row)
+    bitmap = ''.join([chr((bits >> (8 * i)) & 0xff) for i in range(nbytes - 1, -1, -1)])
+    return 'D' + bitmap + ''.join(fields)
+
+
+def synthetic_result(typenames, nrows, null_every=0):
+    """
+    Build a Result with one column for each pgsql type name listed
+    (which should be keys of SAMPLE_VALUES), and nrows rows of sample
+    values.  If null_every is non-zero, every null_every'th value
+    is NULL.
+
+    """
+    columns = [('c%d' % i, t) for i, t in enumerate(typenames)]
+    makers = [SAMPLE_VALUES[t] for t in typenames]
+    rows = []
+    n = 0
+    for i in range(nrows):
+        row = []
+        for make in makers:
+            n += 1
+            if null_every and (n % null_every == 0):
+                row.append(None)
+            else:
+                row.append(make(i))
+        rows.append(row)
+    return Result(columns, rows)
+
+
+class _LargeObjectFD(object):
+    """
+    An opened Large Object
+
+    """
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+
+class _Backend(object):
+    """
+    Handle a single client connection.
+
+    """
+    def __init__(self, server, sock, pid):
+        self.server = server
+        self.sock = sock
+        self.pid = pid
+        self.key = None
+        self.cancel_requested = False
+        self.write_lock = threading.RLock()
+        self.buffer = ''
+        self.lo_fds = {}
+
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError
+            self.buffer += data
+        result, self.buffer = self.buffer[:n], self.buffer[n:]
+        return result
+
+
+    def read_string(self, terminator='\0'):
+        while terminator not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError
+            self.buffer += data
+        result, self.buffer = self.buffer.split(terminator, 1)
+        return result
+
+
+    def send(self, data):
+        self.write_lock.acquire()
+        try:
+            self.sock.sendall(data)
+        finally:
+            self.write_lock.release()
+
+
+    def run(self, startup):
+        try:
+            try:
+                self.startup(startup)
+                while True:
+                    msg = self.read(1)
+                    if msg == 'Q':
+                        self.query(self.read_string())
+                    elif msg == 'F':
+                        self.funcall()
+                    elif msg == 'X':
+                        break
+                    else:
+                        self.send('E' + 'FATAL:  unexpected message type %r\n\0' % msg)
+                        break
+            except (EOFError, socket.error):
+                pass
+        finally:
+            self.server._remove_backend(self)
+            self.sock.close()
+
+
+    def startup(self, startup):
+        # startup is the packet after its length: version,
+        # dbname, user, options, unused, tty
+        self.user = startup[68:100].rstrip('\0')
+
+        password = self.server.password
+        if password is not None:
+            import hashlib
+            salt = '\x01\x02\x03\x04'
+            self.send('R' + pack('!i', 5) + salt)
+            size, = unpack('!i', self.read(4))
+            response = self.read(size - 4).rstrip('\0')
+            expected = hashlib.md5(password + self.user).hexdigest()
+            expected = 'md5' + hashlib.md5(expected + salt).hexdigest()
+            if response != expected:
+                self.send('E' + 'FATAL:  password authentication failed for user "%s"\n\0' % self.user)
+                raise EOFError
+
+        self.send('R' + pack('!i', 0) + 'K' + pack('!ii', self.pid, self.key) + 'Z')
+
+
+    def query(self, cmd):
+        self.cancel_requested = False
+        self.write_lock.acquire()
+        try:
+            self.send(self.server._respond(self, cmd) + 'Z')
+        finally:
+            self.write_lock.release()
+
+
+    def funcall(self):
+        self.read(1)    # the '\0' after 'F'
+        oid, nargs = unpack('!Ii', self.read(8))
+        args = []
+        for i in range(nargs):
+            size, = unpack('!i', self.read(4))
+            args.append(self.read(size))
+
+        func = self.server.functions.get(oid)
+        if func is None:
+            self.send('E' + 'ERROR:  function %d does not exist\n\0' % oid + 'Z')
+            return
+        try:
+            result = func(self, *args)
+        except Exception, e:
+            self.send('E' + 'ERROR:  %s\n\0' % e + 'Z')
+            return
+        if result is None:
+            self.send('V0Z')
+        else:
+            self.send('VG' + pack('!i', len(result)) + result + '0Z')
+
+
+    def copy_in(self):
+        #
+        # Read lines sent by the client up to the '\.' terminator
+        #
+        data = '\n' + self.buffer
+        start = 0
+        while True:
+            end = data.find('\n\\.\n', start)
+            if end >= 0:
+                break
+            start = max(len(data) - 3, 0)
+            more = self.sock.recv(65536)
+            if not more:
+                raise EOFError
+            data += more
+        self.buffer = data[end + 4:]
+        if end == 0:
+            return []
+        return data[1:end].split('\n')
+
+
+    def notify(self, name, pid):
+        self.send('A' + pack('!i', pid) + name + '\0')
+
+
+def _int_arg(arg):
+    return unpack('!i', arg)[0]
+
+
+def _lo_creat(backend, mode):
+    server = backend.server
+    server.lock.acquire()
+    try:
+        oid = server.next_oid
+        server.next_oid += 1
+        server.large_objects[oid] = bytearray()
+    finally:
+        server.lock.release()
+    return pack('!i', oid)
+
+
+def _lo_open(backend, oid, mode):
+    oid = unpack('!I', oid)[0]
+    data = backend.server.large_objects.get(oid)
+    if data is None:
+        raise ValueError('large object %d does not exist' % oid)
+    fd = len(backend.lo_fds)
+    while fd in backend.lo_fds:
+        fd += 1
+    backend.lo_fds[fd] = _LargeObjectFD(data)
+    return pack('!i', fd)
+
+
+def _lo_close(backend, fd):
+    del backend.lo_fds[_int_arg(fd)]
+    return pack('!i', 0)
+
+
+def _loread(backend, fd, size):
+    lobj = backend.lo_fds[_int_arg(fd)]
+    result = str(lobj.data[lobj.pos:lobj.pos + _int_arg(size)])
+    lobj.pos += len(result)
+    return result
+
+
+def _lowrite(backend, fd, data):
+    lobj = backend.lo_fds[_int_arg(fd)]
+    lobj.data[lobj.pos:lobj.pos + len(data)] = data
+    lobj.pos += len(data)
+    return pack('!i', len(data))
+
+
+def _lo_lseek(backend, fd, offset, whence):
+    lobj = backend.lo_fds[_int_arg(fd)]
+    offset = _int_arg(offset)
+    whence = _int_arg(whence)
+    if whence == 1:
+        offset += lobj.pos
+    elif whence == 2:
+        offset += len(lobj.data)
+    lobj.pos = offset
+    return pack('!i', offset)
+
+
+def _lo_tell(backend, fd):
+    return pack('!i', backend.lo_fds[_int_arg(fd)].pos)
+
+
+def _lo_unlink(backend, oid):
+    del backend.server.large_objects[unpack('!I', oid)[0]]
+    return pack('!i', 1)
+
+
+_LO_IMPLEMENTATIONS = {
+    'lo_creat': _lo_creat,
+    'lo_create': lambda backend, oid: _lo_creat(backend, None),
+    'lo_open': _lo_open,
+    'lo_close': _lo_close,
+    'loread': _loread,
+    'lowrite': _lowrite,
+    'lo_lseek': _lo_lseek,
+    'lo_tell': _lo_tell,
+    'lo_unlink': _lo_unlink,
+    }
+
+_CHANNEL = r'("(?:[^"]|"")+"|[\w$]+)'
+_LISTEN = re.compile(r'\s*(UN)?LISTEN\s+' + _CHANNEL + r'\s*$', re.I)
+_NOTIFY = re.compile(r'\s*NOTIFY\s+' + _CHANNEL + r'\s*$', re.I)
+_SELECT_INTEGER = re.compile(r'\s*SELECT\s+(-?\d+)\s*$', re.I)
+_SLEEP = re.compile(r'\s*SELECT\s+pg_sleep\(\s*([\d.]+)\s*\)\s*$', re.I)
+_INSERT = re.compile(r'\s*INSERT\b', re.I)
+_INSERT_ROWS = re.compile(r'\)\s*,\s*\(')
+_COPY_IN = re.compile(r'\s*COPY\b.*\bFROM\s+STDIN\s*$', re.I)
+_COPY_OUT = re.compile(r'\s*COPY\s+(.*?)\s+TO\s+STDOUT\s*$', re.I)
+_PG_PROC = re.compile(r"\s*SELECT oid, prorettype, proargtypes FROM pg_proc WHERE oid = E?'([\w$]+).*'::regproc(?:edure)?\s*$", re.I)
+_STATEMENT = re.compile(r"(?:[^;']|'[^']*')+")
+_SIMPLE_TAGS = re.compile(r'\s*(BEGIN|COMMIT|ROLLBACK|SET|CREATE TABLE|DROP TABLE)\b', re.I)
+
+
+def _channel_name(s):
+    if s.startswith('"'):
+        return s[1:-1].replace('""', '"')
+    return s.lower()
+
+
+class StubServer(object):
+    """
+    Fake PostgreSQL server listening on a Unix socket in a temporary
+    directory, serving each connection from its own thread.  Connect
+    to it using the 'dsn' attribute.  If password is specified,
+    clients must authenticate with it using MD5.
+
+    Results for commands are added with add_result(), commands not
+    recognized get an error response.
+
+    """
+    def __init__(self, password=None):
+        self.password = password
+        self.lock = threading.Lock()
+        self.handlers = []
+        self.functions = {}
+        self.procs = {}
+        self.function_lookups = 0
+        self.large_objects = {}
+        self.next_oid = 100000
+        self.copied = []
+        self.inserted = 0
+        self.listeners = {}
+        self.backends = {}
+        self.next_pid = 1000
+
+        self.add_result('SELECT oid, typname FROM pg_type',
+            Result([('oid', 'oid'), ('typname', 'name')], [[str(oid), name] for oid, name in TYPES]))
+        self.add_result("SELECT proname, oid FROM pg_proc WHERE proname like 'lo%'",
+            Result([('proname', 'name'), ('oid', 'oid')], [[name, str(oid)] for oid, name in LO_FUNCTIONS]))
+        for oid, name in LO_FUNCTIONS:
+            self.functions[oid] = _LO_IMPLEMENTATIONS[name]
+        self.add_result(_PG_PROC, self.__describe_function)
+
+        self.directory = tempfile.mkdtemp(prefix='pgstub')
+        self.path = os.path.join(self.directory, '.s.PGSQL.5432')
+        self.dsn = 'host=%s user=stub dbname=stub' % self.path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(64)
+
+        self.__running = True
+        self.__threads = []
+        self.__thread = threading.Thread(target=self.__accept)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+
+    def __accept(self):
+        while self.__running:
+            try:
+                sock, _ = self.sock.accept()
+            except socket.error:
+                break
+            t = threading.Thread(target=self.__start_backend, args=(sock,))
+            t.setDaemon(True)
+            t.start()
+            self.__threads.append(t)
+
+
+    def __start_backend(self, sock):
+        backend = _Backend(self, sock, None)
+        try:
+            size, = unpack('!i', backend.read(4))
+            startup = backend.read(size - 4)
+        except (EOFError, socket.error):
+            sock.close()
+            return
+
+        if (size == 16) and (unpack('!i', startup[:4])[0] == CANCEL_REQUEST_CODE):
+            pid, key = unpack('!ii', startup[4:])
+            self.lock.acquire()
+            try:
+                target = self.backends.get(pid)
+            finally:
+                self.lock.release()
+            if (target is not None) and (target.key == key):
+                target.cancel_requested = True
+            sock.close()
+            return
+
+        self.lock.acquire()
+        try:
+            backend.pid = self.next_pid
+            backend.key = backend.pid * 7919
+            self.next_pid += 1
+            self.backends[backend.pid] = backend
+        finally:
+            self.lock.release()
+        backend.run(startup)
+
+
+    def _remove_backend(self, backend):
+        self.lock.acquire()
+        try:
+            self.backends.pop(backend.pid, None)
+            for listeners in self.listeners.values():
+                listeners.discard(backend)
+        finally:
+            self.lock.release()
+
+
+    def _respond(self, backend, cmd):
+        #
+        # Work out the messages to send in response to a command,
+        # not including the final ReadyForQuery.  Several statements
+        # separated by semicolons get a response each, up to the
+        # first one that fails.
+        #
+        statements = [m.group(0).strip() for m in _STATEMENT.finditer(cmd)]
+        statements = [x for x in statements if x]
+        if len(statements) > 1:
+            responses = []
+            for statement in statements:
+                responses.append(self._respond(backend, statement))
+                if responses[-1].startswith('E'):
+                    break
+            return ''.join(responses)
+
+        response = self.__find_result(cmd)
+        if isinstance(response, Error):
+            return 'E' + 'ERROR:  %s\n\0' % response.message
+        if isinstance(response, Result):
+            return response.encode() + 'C' + response.tag + '\0'
+
+        if not cmd.strip():
+            return 'I\0'
+
+        m = _SIMPLE_TAGS.match(cmd)
+        if m:
+            return 'C' + m.group(1).upper() + '\0'
+
+        m = _LISTEN.match(cmd)
+        if m:
+            name = _channel_name(m.group(2))
+            self.lock.acquire()
+            try:
+                if m.group(1):
+                    self.listeners.get(name, set()).discard(backend)
+                    return 'CUNLISTEN\0'
+                self.listeners.setdefault(name, set()).add(backend)
+            finally:
+                self.lock.release()
+            return 'CLISTEN\0'
+
+        m = _NOTIFY.match(cmd)
+        if m:
+            self.notify(_channel_name(m.group(1)), backend.pid)
+            return 'CNOTIFY\0'
+
+        m = _SELECT_INTEGER.match(cmd)
+        if m:
+            return Result([('?column?', 'int4')], [[m.group(1)]]).encode() + 'CSELECT\0'
+
+        m = _SLEEP.match(cmd)
+        if m:
+            deadline = time.time() + float(m.group(1))
+            while time.time() < deadline:
+                if backend.cancel_requested:
+                    return 'E' + 'ERROR:  canceling statement due to user request\n\0'
+                time.sleep(0.01)
+            return Result([('pg_sleep', 'void')], [['']]).encode() + 'CSELECT\0'
+
+        if _INSERT.match(cmd):
+            n = len(_INSERT_ROWS.findall(cmd)) + 1
+            self.lock.acquire()
+            try:
+                self.inserted += n
+            finally:
+                self.lock.release()
+            return 'CINSERT 0 %d\0' % n
+
+        if _COPY_IN.match(cmd):
+            backend.send('G')
+            lines = backend.copy_in()
+            self.lock.acquire()
+            try:
+                self.copied.extend(lines)
+            finally:
+                self.lock.release()
+            return 'CCOPY\0'
+
+        m = _COPY_OUT.match(cmd)
+        if m:
+            # Send the rows that 'SELECT * FROM <table>' would return
+            result = self.__find_result('SELECT * FROM ' + m.group(1))
+            if not isinstance(result, Result):
+                return 'E' + 'ERROR:  stub server has no table for: %s\n\0' % cmd
+            lines = []
+            for row in result.rows:
+                lines.append('\t'.join([(v is None and '\\N') or v for v in row]) + '\n')
+            backend.send('H' + ''.join(lines) + '\\.\n')
+            return 'CCOPY\0'
+
+        return 'E' + 'ERROR:  stub server has no result for: %s\n\0' % cmd
+
+
+    def __find_result(self, cmd):
+        #
+        # Find the response added for a command, or None
+        #
+        for pattern, response in self.handlers:
+            if isinstance(pattern, basestring):
+                if pattern != cmd:
+                    continue
+                match = None
+            else:
+                match = pattern.match(cmd)
+                if match is None:
+                    continue
+            if callable(response):
+                response = response(match)
+            return response
+        return None
+
+
+    def __describe_function(self, match):
+        #
+        # Look up a function added with add_function() for
+        # Connection.fastcall() (ignoring any argument types)
+        #
+        self.function_lookups += 1
+        proc = self.procs.get(match.group(1))
+        if proc is None:
+            return Error('function "%s" does not exist' % match.group(1))
+        oid, argtypes, rettype = proc
+        return Result([('oid', 'oid'), ('prorettype', 'oid'), ('proargtypes', 'oidvector')],
+            [[str(oid), str(TYPE_OIDS[rettype]), ' '.join([str(TYPE_OIDS[t]) for t in argtypes])]])
+
+
+    def add_function(self, name, argtypes, rettype, func):
+        """
+        Add a function that can be looked up in pg_proc and called with
+        the fastpath function call protocol.  argtypes is a list of pgsql
+        type names, and rettype a type name.  func is called with the
+        backend and the binary representation of each argument, and
+        should return the binary representation of the result (or None).
+        Returns the function's oid.
+
+        """
+        self.lock.acquire()
+        try:
+            oid = self.next_oid
+            self.next_oid += 1
+        finally:
+            self.lock.release()
+        self.procs[name] = (oid, argtypes, rettype)
+        self.functions[oid] = func
+        return oid
+
+
+    def add_result(self, pattern, response):
+        """
+        Specify the response to a command.  'pattern' is either the exact
+        command text, or a compiled regular expression to match against it.
+        'response' is a Result or Error object, or a callable taking the
+        regular expression match object (None for exact matches) and
+        returning one.  Later additions don't override earlier ones.
+
+        """
+        self.handlers.append((pattern, response))
+
+
+    def close(self):
+        """
+        Stop accepting connections, close existing ones, and clean up
+        the socket.
+
+        """
+        self.__running = False
+        try:
+            # wakes up the thread blocked in accept()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.lock.acquire()
+        try:
+            backends = self.backends.values()
+        finally:
+            self.lock.release()
+        for backend in backends:
+            try:
+                backend.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.__thread.join(1.0)
+        for t in self.__threads:
+            t.join(1.0)
+        shutil.rmtree(self.directory, True)
+
+
+    def notify(self, name, pid):
+        """
+        Send an async notification to all connections listening for 'name'
+
+        """
+        self.lock.acquire()
+        try:
+            listeners = list(self.listeners.get(name, ()))
+        finally:
+            self.lock.release()
+        for backend in listeners:
+            try:
+                backend.notify(name, pid)
+            except socket.error:
+                pass
@@ -5,14 +5,27 @@ BPgSQL unittests
 2004-03-29 Barry Pederson <bp@barryp.org>
 
 """
+import errno
+import gc
+import os
+import pickle
+import select
+import socket
+import sys
+import tempfile
 import unittest
-from datetime import date, datetime, time
+import uuid
+from array import array
+from datetime import date, datetime, time, timedelta
 try:
     from decimal import Decimal
 except:
     Decimal = float
 from optparse import OptionParser
+from StringIO import StringIO
+from time import sleep
 import bpgsql
+import pgstub
 
 DEFAULT_DSN = 'host=10.66.0.1 user=barryp dbname=test'
 
@@ -116,8 +129,308 @@ class InternalDSNParserTests(unittest.TestCase):
         self.assertEqual(d['j'], '21 32 abc')
 
 
+class SpillingRowsTests(unittest.TestCase):
+    """
+    Test the internal list-like class that spills result rows
+    to a temp file once a memory budget is exceeded.
+
+    """
+    def setUp(self):
+        stamp = bpgsql._timestamp_to_python('2008-06-11 10:11:12.5-05')
+        self.expected = [[i, u'row %d' % i, None, Decimal(i), stamp] for i in range(200)]
+        self.rows = bpgsql._SpillingRows(2000)
+        for row in self.expected:
+            self.rows.append(row)
+
+    def test_spilled(self):
+        self.assert_(self.rows.memory_used > self.rows.memory_limit)
+        self.assertEqual(len(self.rows), 200)
+        self.assertEqual(self.rows.in_memory(), None)
+        rows = bpgsql._SpillingRows(1000000)
+        rows.append(self.expected[0])
+        self.assertEqual(rows.in_memory(), self.expected[:1])
+
+    def test_index(self):
+        for i in range(200):
+            self.assertEqual(self.rows[i], self.expected[i])
+        self.assertEqual(self.rows[199][4].utcoffset(), timedelta(hours=-5))
+        self.assertEqual(self.rows[-1], self.expected[-1])
+        self.assertRaises(IndexError, self.rows.__getitem__, 200)
+
+    def test_slice(self):
+        self.assertEqual(self.rows[0:5], self.expected[0:5])
+        self.assertEqual(self.rows[3:150], self.expected[3:150])
+        self.assertEqual(self.rows[190:300], self.expected[190:300])
+        self.assertEqual(self.rows[250:300], [])
+        self.assertEqual(list(self.rows), self.expected)
+
+    def test_unlimited(self):
+        rows = bpgsql._SpillingRows(10**9)
+        rows.append([1, 2])
+        self.assertEqual(rows[0:10], [[1, 2]])
+
+
+def make_result(*rows):
+    """
+    Build a single-column ResultSet like the Connection
+    class would, for testing the result caches.
+
+    """
+    result = bpgsql._ResultSet()
+    result.set_description([('x', bpgsql.NUMBER, None, None, None, None, None)])
+    result.rows.extend([[r] for r in rows])
+    result.completed = 'SELECT'
+    return result
+
+
+class ResultCacheTests(unittest.TestCase):
+    """
+    Test the query result cache without involving a connection.
+
+    """
+
+    def test_lookup(self):
+        cache = bpgsql.ResultCache()
+        self.assertEqual(cache.lookup('SELECT 1'), None)
+        cache.store('SELECT 1', make_result(1))
+        result = cache.lookup('SELECT 1')
+        self.assertEqual(result.rows, [[1]])
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+        # Callers get their own list of rows
+        result.rows.pop()
+        self.assertEqual(cache.lookup('SELECT 1').rows, [[1]])
+
+    def test_not_cacheable(self):
+        cache = bpgsql.ResultCache()
+        cache.store('UPDATE foo SET x=1', make_result())
+        self.assertEqual(len(cache), 0)
+        result = make_result()
+        result.error = bpgsql.DatabaseError('oops')
+        cache.store('SELECT 1', result)
+        self.assertEqual(len(cache), 0)
+        for query in ['SELECT * FROM foo FOR UPDATE', 'SELECT * FROM foo for no key update',
+                'SELECT * FROM foo FOR SHARE', 'SELECT * INTO bar FROM foo', "SELECT nextval('foo_seq')",
+                'SELECT random()', 'SELECT * FROM foo WHERE t < NOW ()', 'SELECT current_timestamp']:
+            self.assertEqual(cache.is_cacheable(query), False, query)
+        self.assertEqual(cache.is_cacheable('SELECT * FROM foo WHERE updated < %s' % "'2008-06-11'"), True)
+
+    def test_servers(self):
+        # The same query sent to different databases is cached separately
+        cache = bpgsql.ResultCache()
+        cache.store('SELECT 1', make_result(1), ('localhost', '5432', 'a'))
+        cache.store('SELECT 1', make_result(2), ('localhost', '5432', 'b'))
+        self.assertEqual(cache.lookup('SELECT 1', ('localhost', '5432', 'a')).rows, [[1]])
+        self.assertEqual(cache.lookup('SELECT 1', ('localhost', '5432', 'b')).rows, [[2]])
+        self.assertEqual(cache.lookup('SELECT 1', ('localhost', '5432', 'c')), None)
+        self.assertEqual(cache.lookup('SELECT 1'), None)
+
+    def test_invalidated_while_running(self):
+        cache = bpgsql.ResultCache()
+        generations = cache.generations('SELECT * FROM foo, bar')
+        cache.invalidate('bar')
+        cache.store('SELECT * FROM foo, bar', make_result(1), None, generations)
+        self.assertEqual(len(cache), 0)
+
+        generations = cache.generations('SELECT * FROM foo, bar')
+        cache.invalidate('baz')
+        cache.store('SELECT * FROM foo, bar', make_result(1), None, generations)
+        self.assertEqual(len(cache), 1)
+
+        generations = cache.generations('SELECT * FROM foo')
+        cache.clear()
+        cache.store('SELECT * FROM foo', make_result(1), None, generations)
+        self.assertEqual(len(cache), 0)
+
+    def test_lru(self):
+        cache = bpgsql.ResultCache(max_entries=2)
+        cache.store('SELECT 1', make_result(1))
+        cache.store('SELECT 2', make_result(2))
+        cache.lookup('SELECT 1')
+        cache.store('SELECT 3', make_result(3))
+        self.assertEqual(len(cache), 2)
+        self.assertNotEqual(cache.lookup('SELECT 1'), None)
+        self.assertEqual(cache.lookup('SELECT 2'), None)
+        self.assertNotEqual(cache.lookup('SELECT 3'), None)
+
+    def test_ttl(self):
+        cache = bpgsql.ResultCache(ttl=0)
+        cache.store('SELECT 1', make_result(1))
+        self.assertEqual(cache.lookup('SELECT 1'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = bpgsql.ResultCache()
+        self.assertEqual(sorted(cache.tags('SELECT * FROM foo JOIN public.Bar ON x=y')), ['bar', 'foo'])
+        self.assertEqual(sorted(cache.tags('SELECT * FROM foo f, public.bar AS b, baz WHERE f.x = b.y')),
+            ['bar', 'baz', 'foo'])
+        self.assertEqual(sorted(cache.tags('SELECT * FROM (SELECT x FROM foo, bar) s, baz ORDER BY x')),
+            ['bar', 'baz', 'foo'])
+        self.assertEqual(sorted(cache.tags('SELECT * FROM "Users" u JOIN public."Order""s" o ON x=y')),
+            ['order"s', 'users'])
+        self.assertEqual(sorted(cache.tags('SELECT * FROM ONLY parts p JOIN ONLY public.bar ON x=y')),
+            ['bar', 'parts'])
+        # nothing could invalidate results from tables without tags
+        self.assertEqual(cache.is_cacheable('SELECT * FROM ONLY (parts)'), False)
+        self.assertEqual(cache.is_cacheable('SELECT 1'), True)
+        cache.store('SELECT * FROM foo JOIN bar ON x=y', make_result(1))
+        cache.store('SELECT * FROM foo', make_result(2))
+        cache.store('SELECT * FROM baz', make_result(3))
+        cache.invalidate('bar')
+        self.assertEqual(len(cache), 2)
+        cache.invalidate('foo')
+        self.assertEqual(len(cache), 1)
+        self.assertNotEqual(cache.lookup('SELECT * FROM baz'), None)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class StatementStatisticsTests(unittest.TestCase):
+    """
+    Test collecting statistics from QueryStats objects, without
+    involving a connection.
+
+    """
+    def make_stats(self, template, elapsed, rowcount=1):
+        stats = bpgsql.QueryStats(template, template)
+        stats.ready_time = elapsed
+        stats.rowcount = rowcount
+        return stats
+
+    def test_normalize(self):
+        self.assertEqual(bpgsql._normalize_query(
+            "SELECT  *\n FROM foo WHERE a=%s AND b = %(bee)s AND c='it''s' AND d=E'x' AND e=-1.5e3 AND f1=2"),
+            "SELECT * FROM foo WHERE a=? AND b = ? AND c=? AND d=? AND e=? AND f1=?")
+
+    def test_collect(self):
+        collector = bpgsql.StatementStatistics()
+        for i in range(100):
+            collector(self.make_stats("SELECT * FROM foo WHERE id=%d" % i, (i + 1) / 1000.0))
+        collector(self.make_stats("UPDATE foo SET x = 1", 0.5, 3))
+
+        snapshot = collector.snapshot()
+        self.assertEqual(len(snapshot), 2)
+        select, update = snapshot
+        self.assertEqual(update['query'], 'UPDATE foo SET x = ?')
+        self.assertEqual(update['rows'], 3)
+        self.assertEqual(select['query'], 'SELECT * FROM foo WHERE id=?')
+        self.assertEqual(select['calls'], 100)
+        self.assertEqual(select['rows'], 100)
+        self.assertAlmostEqual(select['total_time'], 5.05)
+        self.assertAlmostEqual(select['mean_time'], 0.0505)
+        self.assertAlmostEqual(select['max_time'], 0.1)
+
+        # Percentiles are only as good as the histogram buckets
+        self.assert_(0.050 <= select['p50'] < 0.050 * 1.2)
+        self.assert_(0.095 <= select['p95'] < 0.095 * 1.2)
+        self.assert_(0.099 <= select['p99'] <= 0.1)
+
+        collector.reset()
+        self.assertEqual(collector.snapshot(), [])
+
+
+class SharedResultCacheTests(unittest.TestCase):
+    """
+    Test the memory-mapped result cache, using two cache objects
+    on the same file to stand in for two processes.
+
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.path)
+        self.cache = bpgsql.SharedResultCache(self.path, slots=16, slot_size=4096)
+        self.other = bpgsql.SharedResultCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        self.other.close()
+        os.unlink(self.path)
+
+    def test_shared(self):
+        tz = bpgsql._timestamp_to_python('2008-06-11 10:11:12.5-05')
+        result = make_result(Decimal('1.5'), tz, None, u'\u1234')
+        self.cache.store('SELECT * FROM foo', result)
+        self.assertEqual(self.other.max_entries, 16)
+        self.assertEqual(len(self.other), 1)
+
+        hit = self.other.lookup('SELECT * FROM foo')
+        self.assertEqual(hit.rows[:], result.rows)
+        self.assertEqual(len(hit.rows), 4)
+        self.assertEqual(hit.rows[1][0].utcoffset(), tz.utcoffset())
+        self.assert_(hit.description[0][1] is bpgsql.NUMBER)
+        self.assertEqual(hit.completed, 'SELECT')
+
+        self.other.invalidate('foo')
+        self.assertEqual(self.cache.lookup('SELECT * FROM foo'), None)
+
+    def test_too_big(self):
+        self.cache.store('SELECT 1', make_result('x' * 5000))
+        self.assertEqual(self.other.lookup('SELECT 1'), None)
+
+    def test_lookup(self):
+        self.cache.store('SELECT 1', make_result(1))
+        self.assertEqual(self.cache.lookup('SELECT 1').rows[0], [1])
+        self.assertEqual(self.cache.lookup('SELECT 2'), None)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_ttl(self):
+        cache = bpgsql.SharedResultCache(self.path, ttl=0)
+        cache.store('SELECT 1', make_result(1))
+        self.assertEqual(cache.lookup('SELECT 1'), None)
+        cache.close()
+
+    def test_clear(self):
+        self.cache.store('SELECT 1', make_result(1))
+        self.cache.store('UPDATE foo SET x=1', make_result(1))
+        self.assertEqual(len(self.cache), 1)
+        self.other.clear()
+        self.assertEqual(len(self.cache), 0)
+
+        # a result from before the cache was cleared isn't stored
+        generations = self.cache.generations('SELECT * FROM foo')
+        self.other.clear()
+        self.cache.store('SELECT * FROM foo', make_result(1), None, generations)
+        self.assertEqual(self.other.lookup('SELECT * FROM foo'), None)
+        self.cache.store('SELECT * FROM foo', make_result(1))
+        self.assertNotEqual(self.other.lookup('SELECT * FROM foo'), None)
+
+    def test_invalidated_while_running(self):
+        generations = self.cache.generations('SELECT * FROM foo, bar')
+        self.other.invalidate('bar')
+        self.cache.store('SELECT * FROM foo, bar', make_result(1), None, generations)
+        self.assertEqual(self.other.lookup('SELECT * FROM foo, bar'), None)
+
+        generations = self.cache.generations('SELECT * FROM foo, bar')
+        self.cache.store('SELECT * FROM foo, bar', make_result(1), None, generations)
+        self.assertNotEqual(self.other.lookup('SELECT * FROM foo, bar'), None)
+
+    def test_servers(self):
+        self.cache.store('SELECT 1', make_result(1), ('localhost', '5432', 'a'))
+        self.assertEqual(self.other.lookup('SELECT 1', ('localhost', '5432', 'a')).rows[0], [1])
+        self.assertEqual(self.other.lookup('SELECT 1', ('localhost', '5432', 'b')), None)
+
+    def test_close(self):
+        cache = bpgsql.SharedResultCache(self.path)
+        cache.close()
+        cache.close()
+        self.assertRaises(bpgsql.InterfaceError, cache.lookup, 'SELECT 1')
+
+
 class TypeTests(ConnectedTests):
 
+    def test_array(self):
+        self.cur.execute("SELECT ARRAY[1, 2, 3], ARRAY['a', NULL, 'b c', 'NULL'], ARRAY[[1.5, 2], [3, 4]]::float8[], %s, %s",
+            ([1, 2], [u'x', u'"y"']))
+        row = self.cur.fetchone()
+        self.assertEqual(row[0], array('i', [1, 2, 3]))
+        self.assertEqual(row[1], [u'a', None, u'b c', u'NULL'])
+        self.assertEqual(row[2], [array('d', [1.5, 2.0]), array('d', [3.0, 4.0])])
+        self.assertEqual(row[3], array('i', [1, 2]))
+        self.assertEqual(row[4], [u'x', u'"y"'])
+
     def test_binary(self):
         b = bpgsql.Binary(''.join([chr(x) for x in range(256)]))
         self.cur.execute(r"SELECT %s, 'foo'::bytea", (b,))
@@ -434,6 +747,845 @@ class LargeObjectTests(ConnectedTests):
             self.cnx.lo_unlink(loid)
             self.cnx.commit()
 
+        def test_lobj_streaming(self):
+            data = ''.join([chr(i % 251) for i in range(300000)])
+            self.cur.execute("BEGIN")
+            loid = self.cnx.lo_create()
+
+            o = self.cnx.lo_open(loid, bpgsql.INV_WRITE)
+            self.assertEqual(o.copy_from_file(StringIO(data), 10000), len(data))
+            o.close()
+
+            o = self.cnx.lo_open(loid, bpgsql.INV_READ)
+            chunks = list(o.iter_chunks(65536))
+            self.assertEqual([len(c) for c in chunks], [65536] * 4 + [37856])
+            self.assertEqual(''.join(chunks), data)
+
+            o.seek(1000, bpgsql.SEEK_SET)
+            buf = bytearray(100000)
+            self.assertEqual(o.readinto(buf), 100000)
+            self.assertEqual(str(buf), data[1000:101000])
+            self.assertEqual(o.tell(), 101000)
+
+            # stopping iteration early leaves the connection usable,
+            # positioned after what was consumed
+            for chunk in o.iter_chunks(1000):
+                break
+            self.assertEqual(o.tell(), 102000)
+            self.assertEqual(o.read(10), data[102000:102010])
+            chunks = o.iter_chunks(1000)
+            self.assertEqual(chunks.next(), data[102010:103010])
+            self.assertEqual(chunks.next(), data[103010:104010])
+            chunks.close()
+            self.assertEqual(o.tell(), 104010)
+            o.seek(299000, bpgsql.SEEK_SET)
+            out = StringIO()
+            self.assertEqual(o.copy_to_file(out), 1000)
+            self.assertEqual(out.getvalue(), data[299000:])
+            o.close()
+
+            # errors are raised, not lost
+            self.assertRaises(bpgsql.DatabaseError, self.cnx.lo_open, loid + 1000)
+            self.cnx.rollback()
+
+        def test_lobj_files(self):
+            directory = tempfile.mkdtemp()
+            try:
+                for size in [0, 1, 200000]:
+                    data = ''.join([chr(i % 251) for i in range(size)])
+                    src = os.path.join(directory, 'src')
+                    dst = os.path.join(directory, 'dst')
+                    f = open(src, 'wb')
+                    f.write(data)
+                    f.close()
+
+                    self.cur.execute("BEGIN")
+                    loid = self.cnx.lo_import(src)
+                    self.assertEqual(self.cnx.lo_export(loid, dst), size)
+                    self.cnx.lo_unlink(loid)
+                    self.cnx.commit()
+
+                    self.assertEqual(open(dst, 'rb').read(), data)
+            finally:
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+                os.rmdir(directory)
+
+
+class NotifyTests(ConnectedTests):
+        def test_get_notifies(self):
+            self.assertEqual(self.cnx.get_notifies(), [])
+            self.cur.execute('LISTEN test_notify')
+            self.cur.execute('NOTIFY test_notify')
+            self.cur.execute('NOTIFY test_notify')
+            notifies = self.cnx.get_notifies(1.0)
+            self.assertEqual([n[0] for n in notifies], ['test_notify'] * 2)
+            self.assertEqual(self.cnx.get_notifies(), [])
+
+        def test_listener(self):
+            received = []
+            listener = bpgsql.NotifyListener(self.TEST_DSN)
+            listener.listen('test_notify', lambda name, pid: received.append(name))
+            for i in range(5):
+                self.cur.execute('NOTIFY test_notify')
+            self.cur.execute('NOTIFY test_other')
+
+            while not received:
+                listener.dispatch(1.0)
+            self.assertEqual(received, ['test_notify'])
+
+            listener.unlisten('test_notify')
+            self.cur.execute('NOTIFY test_notify')
+            self.assertEqual(listener.dispatch(0.2), 0)
+            listener.close()
+
+        def test_multiplexer(self):
+            others = [bpgsql.connect(self.TEST_DSN) for i in range(3)]
+            mux = bpgsql.NotifyMultiplexer()
+            for i, cnx in enumerate(others):
+                cnx.cursor().execute('LISTEN test_notify_%d' % i)
+                mux.register(cnx)
+
+            self.assertEqual(mux.wait(0), [])
+            self.cur.execute('NOTIFY test_notify_2')
+            self.cur.execute('NOTIFY test_notify_0')
+
+            received = []
+            while len(received) < 2:
+                received.extend(mux.wait(1.0))
+            received.sort()
+            self.assertEqual([(r[0], r[1]) for r in received],
+                sorted([(others[0], 'test_notify_0'), (others[2], 'test_notify_2')]))
+
+            mux.unregister(others[0])
+            self.cur.execute('NOTIFY test_notify_0')
+            self.assertEqual(mux.wait(0.2), [])
+            mux.close()
+            for cnx in others:
+                cnx.close()
+
+
+class QueryHookTests(ConnectedTests):
+        def test_hook(self):
+            collected = []
+            self.cnx.add_query_hook(collected.append)
+            self.cur.execute("SELECT * FROM pg_type LIMIT 5")
+            self.cnx.remove_query_hook(collected.append)
+            self.cur.execute("SELECT 1")
+
+            self.assertEqual(len(collected), 1)
+            stats = collected[0]
+            self.assertEqual(stats.query, "SELECT * FROM pg_type LIMIT 5")
+            self.assertEqual(stats.rowcount, 5)
+            self.assertEqual(stats.command, 'SELECT')
+            self.assertEqual(stats.error, None)
+            self.assertEqual(stats.bytes_sent, len(stats.query) + 2)
+            self.assert_(stats.bytes_received > 0)
+            self.assert_(0 <= stats.send_time <= stats.first_byte_time <= stats.ready_time)
+            self.assert_(0 < stats.conversion_time < stats.ready_time)
+
+
+class ProfilerTests(ConnectedTests):
+        def test_profiler(self):
+            self.cnx.profiler = bpgsql.ProtocolProfiler()
+            self.cur.execute("SELECT 1::int4, 'foo'::text, 1.5::numeric FROM pg_type")
+            report = self.cnx.profiler.report()
+            self.assertEqual(report['commands'], 1)
+            self.assert_(report['wait'] > 0)
+            self.assert_(report['parse'] > 0)
+            self.assertEqual(sorted(report['convert'].keys()), ['int4', 'numeric', 'text'])
+
+            self.cnx.profiler.reset()
+            self.cnx.profiler.sample_rate = 0
+            self.cur.execute("SELECT 1")
+            self.assertEqual(self.cnx.profiler.report()['commands'], 0)
+
+
+class CancelTests(ConnectedTests):
+        def test_timeout(self):
+            self.assertRaises(bpgsql.PostgreSQL_QueryTimeout,
+                self.cur.execute, 'SELECT pg_sleep(10)', timeout=0.2)
+
+            # connection should still be usable
+            self.cur.execute('SELECT 1', timeout=5)
+            self.assertEqual(self.cur.fetchone(), [1])
+
+        def test_cancel(self):
+            import threading
+            t = threading.Timer(0.2, self.cnx.cancel)
+            t.start()
+            self.assertRaises(bpgsql.DatabaseError, self.cur.execute, 'SELECT pg_sleep(10)')
+            t.join()
+            self.cur.execute('SELECT 1')
+            self.assertEqual(self.cur.fetchone(), [1])
+
+
+class StubTests(unittest.TestCase):
+    """
+    Superclass for test suites that run against the fake server
+    in pgstub.py, so they don't need a real database.
+
+    """
+    def setUp(self):
+        self.server = pgstub.StubServer()
+        self.cnx = bpgsql.connect(self.server.dsn)
+        self.cur = self.cnx.cursor()
+
+    def tearDown(self):
+        self.cnx.close()
+        self.server.close()
+        self.cnx = self.cur = self.server = None
+
+
+class StubServerTests(StubTests):
+    def test_select(self):
+        types = ['int4', 'text', 'numeric', 'bool', 'date', 'timestamptz', 'float8', 'int8', 'bytea']
+        self.server.add_result('SELECT * FROM test_foo', pgstub.synthetic_result(types, 5))
+        self.cur.execute('SELECT * FROM test_foo')
+        self.assertEqual(self.cur.rowcount, 5)
+        self.assertEqual(len(self.cur.description), 9)
+        self.assertEqual(self.cur.description[0][1], bpgsql.NUMBER)
+
+        rows = self.cur.fetchall()
+        self.assertEqual(rows[3], [3, u'row number 3', Decimal('3.03'), False,
+            date(2008, 6, 4), rows[3][5], 3.25, 3000000021L, '\0abc\xff3'])
+        self.assertEqual(rows[3][5].utcoffset(), bpgsql._SimpleTzInfo('-05').offset)
+
+    def test_nulls(self):
+        # Enough columns to need more than 32 bits of null flags
+        self.server.add_result('SELECT * FROM test_wide',
+            pgstub.synthetic_result(['int4', 'text'] * 20, 50, null_every=7))
+        self.cur.execute('SELECT * FROM test_wide')
+        rows = self.cur.fetchall()
+        self.assertEqual(len(rows), 50)
+        self.assertEqual(rows[0][:8], [0, u'row number 0', 0, u'row number 0', 0, u'row number 0', None, u'row number 0'])
+        self.assertEqual(rows[0][13], None)
+        self.assertEqual(sum([row.count(None) for row in rows]), 50 * 40 / 7)
+
+    def test_spilled_result(self):
+        types = ['int4', 'text', 'timestamptz', 'numeric']
+        self.server.add_result('SELECT * FROM test_spill', pgstub.synthetic_result(types, 500, null_every=7))
+        self.cur.execute('SELECT * FROM test_spill')
+        expected = self.cur.fetchall()
+
+        self.cnx.result_memory_limit = 10000
+        self.cur.execute('SELECT * FROM test_spill')
+        self.assertEqual(self.cur.rowcount, 500)
+        self.assertEqual(self.cur.fetchmany(3), expected[:3])
+        self.cur.scroll(400, 'absolute')
+        self.assertEqual(self.cur.fetchone(), expected[400])
+        self.assertEqual(self.cur.fetchall(), expected[401:])
+        self.assertEqual(expected[499][2].utcoffset(), timedelta(hours=-5))
+
+        # results that fit in memory are plain lists, so forward-only
+        # cursors can drop rows and the result cache can store them
+        self.cnx.result_memory_limit = 1000000
+        self.cnx.result_cache = cache = bpgsql.ResultCache()
+        self.cur.forward_only = True
+        self.cur.execute('SELECT * FROM test_spill')
+        self.assertEqual(self.cur.fetchone(), expected[0])
+        self.assertRaises(bpgsql.NotSupportedError, self.cur.scroll, -1)
+        self.assertEqual(len(cache), 1)
+
+    def test_hooks_with_profiler(self):
+        # Query hooks and the profiler time each field once between them
+        self.server.add_result('SELECT * FROM test_timed', pgstub.synthetic_result(['int4', 'text'], 200))
+        collected = []
+        self.cnx.add_query_hook(collected.append)
+        self.cnx.profiler = bpgsql.ProtocolProfiler()
+        self.cur.execute('SELECT * FROM test_timed')
+        self.assert_(0 < collected[0].conversion_time < collected[0].ready_time)
+        self.assertEqual(sorted(self.cnx.profiler.report()['convert'].keys()), ['int4', 'text'])
+        self.assertEqual(self.cur.fetchone(), [0, u'row number 0'])
+        self.assertEqual(collected[0].cache_hit, False)
+
+        # and hooks hear about commands answered from the result cache
+        statistics = bpgsql.StatementStatistics()
+        self.cnx.add_query_hook(statistics)
+        self.cnx.result_cache = bpgsql.ResultCache()
+        self.cur.execute('SELECT * FROM test_timed')
+        self.cur.execute('SELECT * FROM test_timed')
+        self.assertEqual([stats.cache_hit for stats in collected], [False, False, True])
+        self.assertEqual(collected[2].rowcount, 200)
+        self.assertEqual(self.cur.rowcount, 200)
+        snapshot = statistics.snapshot()
+        self.assertEqual((snapshot[0]['calls'], snapshot[0]['cache_hits']), (2, 1))
+
+    def test_result_cache_transaction(self):
+        # A transaction's own uncommitted changes aren't NOTIFYed, so
+        # the cache isn't used until it ends
+        self.server.add_result('SELECT * FROM test_foo', pgstub.Result([('a', 'int4')], [['1']]))
+        collected = []
+        self.cnx.add_query_hook(collected.append)
+        self.cnx.result_cache = cache = bpgsql.ResultCache()
+        self.cur.execute('SELECT * FROM test_foo')
+        self.cur.execute('BEGIN')
+        self.cur.execute('SELECT * FROM test_foo')
+        self.cur.execute("INSERT INTO test_foo VALUES (2)")
+        self.cur.execute('SELECT * FROM test_foo')
+        self.cnx.commit()
+        self.cur.execute('SELECT * FROM test_foo')
+        self.assertEqual([stats.cache_hit for stats in collected], [False] * 6 + [True])
+
+    def test_null_bitmap(self):
+        # NULLs at each end of the bitmap's bytes, and a partial last byte
+        self.server.add_result('SELECT * FROM test_bitmap',
+            pgstub.Result([('c%d' % i, 'int4') for i in range(17)], [
+                [None] + [str(i) for i in range(1, 7)] + [None, None] + [str(i) for i in range(9, 16)] + [None],
+                [str(i) for i in range(17)],
+                [None] * 17]))
+        self.cur.execute('SELECT * FROM test_bitmap')
+        rows = self.cur.fetchall()
+        self.assertEqual(rows[0], [None] + range(1, 7) + [None, None] + range(9, 16) + [None])
+        self.assertEqual(rows[1], range(17))
+        self.assertEqual(rows[2], [None] * 17)
+
+    def test_unclosed_connection(self):
+        # Dropping a connection without closing it still disconnects
+        cnx = bpgsql.connect(self.server.dsn)
+        cnx.cursor().execute('SELECT 1')
+        del cnx
+        gc.collect()
+        self.assertEqual(gc.garbage, [])
+        deadline = datetime.now() + timedelta(seconds=5)
+        while (len(self.server.backends) > 1) and (datetime.now() < deadline):
+            select.select([], [], [], 0.01)
+        self.assertEqual(len(self.server.backends), 1)
+
+    def test_error(self):
+        self.assertRaises(bpgsql.DatabaseError, self.cur.execute, 'SELECT * FROM test_missing')
+        self.server.add_result('SELECT 1', pgstub.Error('oops'))
+        self.assertRaises(bpgsql.DatabaseError, self.cur.execute, 'SELECT 1')
+
+    def test_copy(self):
+        self.cnx.stdin = StringIO('1\tone\n2\ttwo\n')
+        self.cur.execute('COPY test_foo FROM STDIN')
+        self.assertEqual(self.server.copied, ['1\tone', '2\ttwo'])
+
+        self.server.add_result('SELECT * FROM test_foo',
+            pgstub.Result([('id', 'int4'), ('name', 'text')], [['1', 'one'], ['2', None]]))
+        self.cnx.stdout = StringIO()
+        self.cur.execute('COPY test_foo TO STDOUT')
+        self.assertEqual(self.cnx.stdout.getvalue(), '1\tone\n2\t\\N\n')
+
+    def test_copy_input_error(self):
+        # An error reading the COPY data doesn't leave the lines read
+        # so far to be sent along with the next command
+        class FailingInput(object):
+            lines = ['1\tone\n', '2\ttwo\n']
+            def readline(self):
+                if not self.lines:
+                    raise IOError('read failed')
+                return self.lines.pop(0)
+        self.cnx.stdin = FailingInput()
+        self.assertRaises(IOError, self.cur.execute, 'COPY test_foo FROM STDIN')
+        self.assertEqual(self.server.copied, [])
+
+        self.server.add_result('SELECT 1', pgstub.Result([('x', 'int4')], [['1']]))
+        self.cur.execute('SELECT 1')
+        self.assertEqual(self.cur.fetchall(), [[1]])
+
+    def test_coalesced_writes(self):
+        log = StringIO()
+        cnx = bpgsql.connect(self.server.dsn, record=log)
+        cnx.stdin = StringIO(''.join(['%d\tline %d\n' % (i, i) for i in range(1000)]))
+        cnx.cursor().execute('COPY test_foo FROM STDIN')
+        self.assertEqual(len(self.server.copied), 1000)
+        cnx.funcall(957, -1)    # lo_creat
+        cnx.close()
+
+        log.seek(0)
+        sends = [data for direction, _, data in bpgsql._read_wire_log(log) if direction == 'S']
+        # the COPY data fits in a single send, and so does the function call
+        self.assertEqual(sends[-4], 'QCOPY test_foo FROM STDIN\0')
+        self.assertEqual(sends[-3], cnx.stdin.getvalue() + '\\.\n')
+        self.assertEqual(sends[-2][:1], 'F')
+        self.assertEqual(sends[-1], 'X')
+
+    def test_arrays(self):
+        self.server.add_result('SELECT * FROM test_arrays', pgstub.Result(
+            [('i', '_int4'), ('t', '_text'), ('f', '_float8'), ('b', '_bool'), ('n', '_numeric')],
+            [['{1,2,3}', '{a,"b c",NULL,"NULL","q\\"\\\\"}', '{{1.5,2},{3,4}}', '{t,f}', '[0:1]={1.5,NULL}'],
+             ['{1,NULL}', '{}', '{}', None, '{}']]))
+        self.cur.execute('SELECT * FROM test_arrays')
+        rows = self.cur.fetchall()
+        self.assertEqual(rows[0], [array('i', [1, 2, 3]), [u'a', u'b c', None, u'NULL', u'q"\\'],
+            [array('d', [1.5, 2.0]), array('d', [3.0, 4.0])], [True, False], [Decimal('1.5'), None]])
+        self.assertEqual(rows[1], [[1, None], [], array('d'), None, []])
+
+        # float4 arrays hold the same values as float4 columns
+        self.server.add_result('SELECT * FROM test_float4', pgstub.Result(
+            [('f', 'float4'), ('a', '_float4')], [['1.1', '{1.1,2.5}']]))
+        self.cur.execute('SELECT * FROM test_float4')
+        self.assertEqual(self.cur.fetchone(), [1.1, array('d', [1.1, 2.5])])
+
+        self.assertEqual(self.cnx._python_to_sql([1, None, 'a']), "ARRAY[1,NULL,E'a']")
+        self.assertEqual(self.cnx._python_to_sql([[1], [2]]), 'ARRAY[ARRAY[1],ARRAY[2]]')
+        self.assertEqual(self.cnx._python_to_sql([]), "'{}'")
+        self.assertEqual(self.cnx._python_to_sql((1, 'a')), "(1, E'a')")
+
+    def test_extended_types(self):
+        self.server.add_result('SELECT * FROM test_types', pgstub.Result(
+            [('u', 'uuid'), ('i', 'interval'), ('j', 'jsonb'), ('a', 'inet'), ('n', 'cidr')],
+            [['a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11', '1 year 2 mons 3 days 04:05:06.5', '{"a": [1, "\xc3\xa9"]}',
+                '10.1.2.3', '10.0.0.0/8'],
+             ['00000000-0000-0000-0000-000000000000', '-1 days +02:03:00', 'null', '::1/128', '::/0'],
+             [None, '-00:00:01', '[]', '10.1.2.3/24', '192.168.0.0/16'],
+             [None, 'P1D', None, None, None]]))
+        self.cur.execute('SELECT * FROM test_types')
+        rows = self.cur.fetchall()
+        self.assertEqual(rows[0][0], uuid.UUID('a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11'))
+        # other IntervalStyles are left as text
+        self.assertEqual([row[1] for row in rows],
+            [timedelta(428, 14706, 500000), timedelta(-1, 7380), timedelta(0, -1), u'P1D'])
+        self.assertEqual([row[2] for row in rows], [{u'a': [1, u'\xe9']}, None, [], None])
+        self.assertEqual(type(rows[0][2]), bpgsql.LazyJSON)
+        if bpgsql.ipaddress is not None:
+            self.assertEqual(rows[0][3], bpgsql.ipaddress.ip_address(u'10.1.2.3'))
+            self.assertEqual(rows[2][3], bpgsql.ipaddress.ip_interface(u'10.1.2.3/24'))
+            self.assertEqual(rows[1][4], bpgsql.ipaddress.ip_network(u'::/0'))
+        else:
+            self.assertEqual(rows[0][3], u'10.1.2.3')
+
+        value = rows[0][2]
+        self.assertEqual(value.text, '{"a": [1, "\xc3\xa9"]}')
+        self.assertEqual(value['a'][1], u'\xe9')
+        self.assertEqual(value, {u'a': [1, u'\xe9']})
+        self.assertEqual('a' in value, True)
+
+        # survives pickling, as when spilled to disk or shared through a cache
+        for value in [bpgsql.LazyJSON('{"b": 2}'), value]:
+            copy = pickle.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            self.assertEqual(copy.text, value.text)
+            self.assertEqual(copy.value, value.value)
+
+        # parsing straight away is an option
+        self.cnx.register_pgsql(['json', 'jsonb'], bpgsql.json.loads, bpgsql.STRING)
+        self.cur.execute('SELECT * FROM test_types')
+        value = self.cur.fetchone()[2]
+        self.assertEqual(value, {u'a': [1, u'\xe9']})
+        self.assertEqual(type(value), dict)
+
+        self.assertEqual(self.cnx._python_to_sql(timedelta(-1, 5, 6)), "'-1 days 5 seconds 6 microseconds'::interval")
+        self.assertEqual(self.cnx._python_to_sql(uuid.UUID(int=1)), "'00000000-0000-0000-0000-000000000001'::uuid")
+
+    def test_numeric_mode(self):
+        # numeric(10,2) and numeric(10,0) have type modifiers of ((10 << 16) | scale) + 4
+        self.server.add_result('SELECT * FROM test_numbers', pgstub.Result(
+            [('a', 'numeric'), ('b', 'numeric', (10 << 16) + 6), ('c', 'numeric', (10 << 16) + 4), ('d', '_numeric')],
+            [['-0012.50', '3.25', '42', '{1.5,2}'], ['-Infinity', 'NaN', 'Infinity', '{Infinity}']]))
+        self.cur.execute('SELECT * FROM test_numbers')
+        row = self.cur.fetchone()
+        self.assertEqual(row, [Decimal('-12.50'), Decimal('3.25'), Decimal('42'), [Decimal('1.5'), Decimal('2')]])
+        self.assertEqual(str(row[0]), '-12.50')
+        row = self.cur.fetchone()
+        self.assertEqual(row[0] + 1, Decimal('-Infinity'))
+        self.assert_(row[1].is_nan())
+        self.assertEqual(row[2] + 1, Decimal('Infinity'))
+        self.assertEqual(row[3][0] + 1, Decimal('Infinity'))
+
+        self.cur.numeric_mode = 'float'
+        self.cur.execute('SELECT * FROM test_numbers')
+        row = self.cur.fetchone()
+        self.assertEqual(row, [-12.5, 3.25, 42.0, array('d', [1.5, 2.0])])
+        self.assertEqual(type(row[2]), float)
+        self.assertEqual(self.cur.fetchone()[2], float('inf'))
+
+        self.cur.numeric_mode = None
+        self.cnx.numeric_mode = 'int'
+        self.cur.execute('SELECT * FROM test_numbers')
+        row = self.cur.fetchone()
+        self.assertEqual(row[:3], [Decimal('-12.50'), Decimal('3.25'), 42])
+        self.assertEqual(type(row[2]), int)
+        self.assertEqual(self.cur.fetchone()[2] + 1, Decimal('Infinity'))
+
+        self.cur.numeric_mode = 'rational'
+        self.assertRaises(bpgsql.InterfaceError, self.cur.execute, 'SELECT * FROM test_numbers')
+
+    def test_nextset(self):
+        self.server.add_result('SELECT * FROM test_sets', pgstub.Result(
+            [('a', 'int4'), ('b', 'text')], [['1', 'one'], ['2', 'two']]))
+
+        self.cur.execute("SELECT 42; INSERT INTO foo VALUES (1), (2); SELECT * FROM test_sets; SELECT ';'")
+        self.assertEqual(self.cur.fetchall(), [[42]])
+        self.assertEqual(self.cur.rowcount, 1)
+
+        self.assertEqual(self.cur.nextset(), True)
+        self.assertEqual(self.cur.description, None)
+        self.assertEqual(self.cur.rowcount, 2)
+
+        self.assertEqual(self.cur.nextset(), True)
+        self.assertEqual([d[0] for d in self.cur.description], ['a', 'b'])
+        self.assertEqual(self.cur.fetchone(), [1, 'one'])
+
+        # skips the remaining row, the stub fails the last statement
+        self.assertRaises(bpgsql.DatabaseError, self.cur.nextset)
+        self.assertEqual(self.cur.description, None)
+        self.assertEqual(self.cur.nextset(), None)
+        self.assertEqual(self.cur.nextset(), None)
+
+        self.cur.execute('SELECT 1')
+        self.assertEqual(self.cur.fetchall(), [[1]])
+        self.assertEqual(self.cur.nextset(), None)
+
+        cur = self.cnx.cursor()
+        self.assertRaises(bpgsql.Error, cur.nextset)
+
+        # multi-statement results aren't cached
+        self.cnx.result_cache = cache = bpgsql.ResultCache()
+        self.cur.execute('SELECT 1; SELECT 2')
+        self.cur.execute('SELECT 1; SELECT 2')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(self.cur.fetchall(), [[1]])
+        self.assertEqual(self.cur.nextset(), True)
+        self.assertEqual(self.cur.fetchall(), [[2]])
+
+    def test_forward_only(self):
+        self.server.add_result('SELECT * FROM test_forward', pgstub.Result(
+            [('a', 'int4')], [[str(i)] for i in range(3000)]))
+        self.cur.forward_only = True
+        self.cur.execute('SELECT * FROM test_forward')
+        self.assertEqual(self.cur.rowcount, 3000)
+        self.assertEqual(self.cur.fetchone(), [0])
+        self.assertEqual(self.cur.fetchmany(4), [[1], [2], [3], [4]])
+        rows = self.cur._Cursor__rows
+        self.assertEqual(rows[:6], [None] * 5 + [[5]])
+
+        # consumed rows are deleted from the list once they're half of it
+        self.assertEqual(len(self.cur.fetchmany(1494)), 1494)
+        self.assertEqual(len(rows), 3000)
+        self.assertEqual(self.cur.next(), [1499])
+        self.assertEqual(len(rows), 1500)
+        self.assertEqual(self.cur.rownumber, 1500)
+
+        self.cur.scroll(9)
+        self.assertEqual(self.cur.fetchone(), [1509])
+        self.cur.scroll(0)
+        self.assertRaises(bpgsql.NotSupportedError, self.cur.scroll, -1)
+        self.assertRaises(bpgsql.NotSupportedError, self.cur.scroll, 0, 'absolute')
+
+        rest = self.cur.fetchall()
+        self.assertEqual(rest, [[i] for i in range(1510, 3000)])
+        self.assert_(rest is rows)
+        self.assertEqual(self.cur.fetchall(), [])
+        self.assertEqual(self.cur.fetchone(), None)
+
+        # iterating and ordinary cursors still see every row
+        self.cur.execute('SELECT * FROM test_forward')
+        self.assertEqual([row[0] for row in self.cur], range(3000))
+        self.cur.forward_only = False
+        self.cur.execute('SELECT * FROM test_forward')
+        self.cur.fetchmany(2000)
+        self.cur.scroll(0, 'absolute')
+        self.assertEqual(self.cur.fetchone(), [0])
+
+    def test_fastcall(self):
+        from struct import pack, unpack
+        self.server.add_function('add_ints', ['int4', 'int8'], 'int8',
+            lambda backend, a, b: pack('!q', unpack('!i', a)[0] + unpack('!q', b)[0]))
+        self.server.add_function('shout', ['text', 'bool'], 'text',
+            lambda backend, s, loud: (loud == '\x01' and s.decode('utf-8').upper().encode('utf-8')) or s)
+        self.server.add_function('halve', ['float8'], 'float8',
+            lambda backend, x: pack('!d', unpack('!d', x)[0] / 2))
+        self.server.add_function('noop', [], 'void', lambda backend: None)
+
+        self.assertEqual(self.cnx.fastcall('add_ints', 2, 5000000000L), 5000000002L)
+        self.assertEqual(self.cnx.fastcall('shout', u'caf\xe9', True), u'CAF\xc9')
+        self.assertEqual(self.cnx.fastcall('shout(text, bool)', 'abc', False), u'abc')
+        self.assertEqual(self.cnx.fastcall('halve', 5.0), 2.5)
+        self.assertEqual(self.cnx.fastcall('noop'), None)
+        self.assertRaises(bpgsql.ProgrammingError, self.cnx.fastcall, 'halve')
+        self.assertRaises(bpgsql.NotSupportedError, self.cnx.fastcall, 'halve', None)
+        self.assertRaises(bpgsql.DatabaseError, self.cnx.fastcall, 'missing')
+
+        # lookups are shared by other connections to the same server
+        lookups = self.server.function_lookups
+        other = bpgsql.connect(self.server.dsn)
+        self.assertEqual(other.fastcall('add_ints', 1, 1), 2)
+        other.close()
+        self.assertEqual(self.server.function_lookups, lookups)
+
+    def test_lobj(self):
+        LargeObjectTests.test_lobj.im_func(self)
+
+    def test_lobj_streaming(self):
+        LargeObjectTests.test_lobj_streaming.im_func(self)
+
+    def test_lobj_files(self):
+        LargeObjectTests.test_lobj_files.im_func(self)
+
+    def test_lobj_function_cache(self):
+        self.cur.execute('BEGIN')
+        self.cnx.lo_unlink(self.cnx.lo_create())
+        self.cnx.commit()
+
+        # a new connection to the same server doesn't look them up again
+        commands = []
+        cnx = bpgsql.connect(self.server.dsn)
+        cnx.add_query_hook(lambda stats: commands.append(stats.query))
+        cnx.cursor().execute('BEGIN')
+        cnx.lo_unlink(cnx.lo_create())
+        cnx.commit()
+        cnx.close()
+        self.assertEqual(commands, ['BEGIN', 'COMMIT'])
+
+    def test_lobj_transfer(self):
+        directory = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i in range(10):
+                paths.append(os.path.join(directory, 'src%d' % i))
+                f = open(paths[-1], 'wb')
+                f.write(str(i) * (i * 10000))
+                f.close()
+
+            progress = []
+            transfer = bpgsql.LargeObjectTransfer(lambda: bpgsql.connect(self.server.dsn), workers=3,
+                progress=lambda done, total, job: progress.append((done, total)))
+            oids = transfer.import_files(paths)
+            self.assertEqual(progress, [(i, 10) for i in range(1, 11)])
+            self.assertEqual(len(set(oids)), 10)
+
+            jobs = [(oid, path.replace('src', 'dst')) for oid, path in zip(oids, paths)]
+            self.assertEqual(transfer.export_files(jobs), [i * 10000 for i in range(10)])
+            for oid, path in jobs:
+                self.assertEqual(open(path, 'rb').read(), str(self.server.large_objects[oid]))
+
+            # failures don't stop the other transfers
+            jobs[3] = (max(oids) + 1, jobs[3][1])
+            self.assertRaises(bpgsql.DatabaseError, transfer.export_files, jobs)
+            self.assertEqual(len(transfer.errors), 1)
+            self.assertEqual(transfer.results[3], None)
+            self.assertEqual(transfer.results[9], 90000)
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_lobj_transfer_lost_connection(self):
+        directory = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i in range(4):
+                paths.append(os.path.join(directory, 'src%d' % i))
+                f = open(paths[-1], 'wb')
+                f.write('x' * 1000)
+                f.close()
+
+            connections = []
+            def connect():
+                if len(connections) >= limit[0]:
+                    raise bpgsql.OperationalError('no more connections')
+                connections.append(bpgsql.connect(self.server.dsn))
+                return connections[-1]
+            def progress(done, total, job):
+                # break the connection after the first transfer
+                if done == 1:
+                    connections[-1]._Connection__socket.shutdown(socket.SHUT_RDWR)
+
+            # the worker carries on with a new connection
+            limit = [2]
+            transfer = bpgsql.LargeObjectTransfer(connect, workers=1, progress=progress)
+            self.assertRaises(socket.error, transfer.import_files, paths)
+            self.assertEqual([job for job, error in transfer.errors], [paths[1]])
+            self.assertEqual([oid is None for oid in transfer.results], [False, True, False, False])
+
+            # jobs left when no connection can be made are reported
+            del connections[:]
+            limit = [1]
+            transfer = bpgsql.LargeObjectTransfer(connect, workers=1, progress=progress)
+            self.assertRaises(socket.error, transfer.import_files, paths)
+            self.assertEqual([job for job, error in transfer.errors],
+                [paths[1], None, paths[2], paths[3]])
+            self.assertEqual([oid is None for oid in transfer.results], [False, True, True, True])
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_notify(self):
+        self.cur.execute('LISTEN test_notify')
+        other = bpgsql.connect(self.server.dsn)
+        other.cursor().execute('NOTIFY test_notify')
+        name, pid = self.cnx.wait_for_notify(5)
+        self.assertEqual(name, 'test_notify')
+        other.close()
+
+    def test_notify_listener_reconnect(self):
+        # A lost connection is reported once and replaced, rather
+        # than the background thread failing over and over
+        import threading
+        class Listener(bpgsql.NotifyListener):
+            poll_interval = 0.05
+            def handle_error(self):
+                errors.append(sys.exc_info()[0])
+        errors = []
+        received = threading.Event()
+        pids = set(self.server.backends)
+        listener = Listener(self.server.dsn)
+        pid = (set(self.server.backends) - pids).pop()
+        listener.listen('test_notify', lambda name, pid: received.set())
+        listener.start()
+
+        self.server.backends[pid].sock.shutdown(socket.SHUT_RDWR)
+        deadline = datetime.now() + timedelta(seconds=5)
+        def listening():
+            return [b for b in self.server.listeners.get('test_notify', ()) if b.pid != pid]
+        while (not listening()) and (datetime.now() < deadline):
+            sleep(0.01)
+        self.cur.execute('NOTIFY test_notify')
+        received.wait(5)
+        self.assert_(received.isSet())
+        self.assertEqual(len(errors), 1)
+        listener.close()
+
+    def test_notify_listener_listen_while_dispatching(self):
+        # listen() isn't held up by dispatch() waiting in another thread
+        import threading
+        listener = bpgsql.NotifyListener(self.server.dsn)
+        received = []
+        listener.listen('first', lambda name, pid: received.append(name))
+        dispatcher = threading.Thread(target=listener.dispatch, args=(-1,))
+        dispatcher.setDaemon(True)
+        dispatcher.start()
+
+        listening = threading.Thread(target=listener.listen,
+            args=('second', lambda name, pid: received.append(name)))
+        listening.setDaemon(True)
+        listening.start()
+        listening.join(2)
+        self.assertFalse(listening.isAlive())
+
+        self.cur.execute('NOTIFY second')
+        dispatcher.join(5)
+        self.assertFalse(dispatcher.isAlive())
+        self.assertEqual(received, ['second'])
+        listener.close()
+
+    def test_notify_multiplexer_dead_connection(self):
+        # A connection whose backend went away doesn't stop the
+        # others from being read
+        mux = bpgsql.NotifyMultiplexer()
+        pids = set(self.server.backends)
+        dead = bpgsql.connect(self.server.dsn)
+        dead_pid = (set(self.server.backends) - pids).pop()
+        alive = bpgsql.connect(self.server.dsn)
+        for cnx in (dead, alive):
+            cnx.cursor().execute('LISTEN test_notify')
+            mux.register(cnx)
+
+        self.server.backends[dead_pid].sock.shutdown(socket.SHUT_RDWR)
+        self.cur.execute('NOTIFY test_notify')
+        received = []
+        deadline = datetime.now() + timedelta(seconds=5)
+        while (len(received) < 2) and (datetime.now() < deadline):
+            received.extend([r[:2] for r in mux.wait(0.5)])
+        self.assertEqual(sorted(received), sorted([(dead, None), (alive, 'test_notify')]))
+        self.assertRaises(bpgsql.OperationalError, dead.get_notifies)
+
+        mux.unregister(dead)
+        mux.close()
+        alive.close()
+
+    def test_timeout(self):
+        CancelTests.test_timeout.im_func(self)
+
+    def test_timeout_interrupted(self):
+        # Signals arriving while waiting don't lose the deadline
+        import signal
+        handler = signal.signal(signal.SIGALRM, lambda signum, frame: None)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.05)
+            self.assertRaises(bpgsql.PostgreSQL_QueryTimeout,
+                self.cur.execute, 'SELECT pg_sleep(2)', timeout=0.3)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+        self.cur.execute('SELECT 1')
+        self.assertEqual(self.cur.fetchone(), [1])
+
+    def test_cancel_timeout(self):
+        # A server that accepts the cancel connection but never answers
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        try:
+            self.cnx._Connection__address = (socket.AF_INET, listener.getsockname())
+            self.assertRaises(bpgsql.OperationalError, self.cnx.cancel, 0.2)
+        finally:
+            listener.close()
+
+    def test_timeout_cancel_failed(self):
+        # If the cancel request can't be sent, the rest of the response
+        # is still read so the connection stays in step with the server
+        def cancel(timeout=None):
+            raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+        self.cnx.cancel = cancel
+        self.assertRaises(bpgsql.OperationalError,
+            self.cur.execute, 'SELECT pg_sleep(0.5)', timeout=0.1)
+        self.server.add_result('SELECT 7', pgstub.Result([('x', 'int4')], [['7']]))
+        self.cur.execute('SELECT 7')
+        self.assertEqual(self.cur.fetchall(), [[7]])
+        self.assertEqual([d[0] for d in self.cur.description], ['x'])
+
+    def test_password(self):
+        server = pgstub.StubServer(password='secret')
+        self.assertRaises(bpgsql.DatabaseError, bpgsql.connect, server.dsn)
+        cnx = bpgsql.connect(server.dsn, password='secret')
+        cnx.close()
+        server.close()
+
+    def test_replay(self):
+        self.server.add_result('SELECT * FROM test_foo', pgstub.synthetic_result(['int4', 'text', 'timestamptz'], 5000))
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cnx = bpgsql.connect(self.server.dsn, record=path)
+            cur = cnx.cursor()
+            cur.execute('SELECT * FROM test_foo')
+            recorded = cur.fetchall()
+            cnx.close()
+
+            sock = bpgsql.ReplaySocket(path)
+            self.assertEqual(sock.frames[0][0], 'S')
+            for i in range(2):
+                sock.rewind()
+                cnx = bpgsql.connect(self.server.dsn, sock=sock)
+                cur = cnx.cursor()
+                # the socket can be polled, after being closed last time round
+                self.assertEqual(select.select([sock], [], [], 0)[0], [sock])
+                # there's no server to send a cancel request to
+                self.assertRaises(bpgsql.NotSupportedError,
+                    cur.execute, 'SELECT * FROM test_foo', timeout=5)
+                cur.execute('SELECT * FROM test_foo')
+                self.assertEqual(cur.fetchall(), recorded)
+                cnx.close()
+                self.assertRaises(socket.error, sock.recv, 1)
+
+            sock.rewind()
+            cnx = bpgsql.connect(self.server.dsn, sock=sock)
+            self.assertRaises(bpgsql.InterfaceError, cnx.cursor().execute, 'SELECT 1')
+            sock.strict = False
+            cnx.close()
+            sock.close()
+        finally:
+            os.remove(path)
+
+    def test_record_sendall(self):
+        a, b = socket.socketpair()
+        log = StringIO()
+        sock = bpgsql._RecordingSocket(a, log)
+        sock.sendall('hello')
+        sock.send('world')
+        self.assertEqual(b.recv(100), 'helloworld')
+        b.sendall('reply')
+        self.assertEqual(sock.recv(100), 'reply')
+        sock.close()
+        b.close()
+        log.seek(0)
+        frames = bpgsql._read_wire_log(log)
+        self.assertEqual([(d, data) for d, _, data in frames], [('S', 'hello'), ('S', 'world'), ('R', 'reply')])
+
 
 def main():
     parser = OptionParser(usage='usage: %prog [options]')
@@ -447,11 +1599,20 @@ def main():
     all_tests = []
     all_tests.append(unittest.makeSuite(DBAPIInterfaceTests, 'test_'))
     all_tests.append(unittest.makeSuite(InternalDSNParserTests, 'test_'))
+    all_tests.append(unittest.makeSuite(SpillingRowsTests, 'test_'))
+    all_tests.append(unittest.makeSuite(ResultCacheTests, 'test_'))
+    all_tests.append(unittest.makeSuite(SharedResultCacheTests, 'test_'))
+    all_tests.append(unittest.makeSuite(StatementStatisticsTests, 'test_'))
     all_tests.append(unittest.makeSuite(TypeTests, 'test_'))
     all_tests.append(unittest.makeSuite(SelectTests, 'test_'))
     all_tests.append(unittest.makeSuite(CursorTests, 'test_'))
     all_tests.append(unittest.makeSuite(BasicTableTests, 'test_'))
     all_tests.append(unittest.makeSuite(LargeObjectTests, 'test_'))
+    all_tests.append(unittest.makeSuite(NotifyTests, 'test_'))
+    all_tests.append(unittest.makeSuite(QueryHookTests, 'test_'))
+    all_tests.append(unittest.makeSuite(ProfilerTests, 'test_'))
+    all_tests.append(unittest.makeSuite(CancelTests, 'test_'))
+    all_tests.append(unittest.makeSuite(StubServerTests, 'test_'))
 
     suite = unittest.TestSuite(all_tests)
 